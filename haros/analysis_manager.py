@@ -266,16 +266,27 @@ class QueryEngine(LoggingObject):
         other_rules = []
         for rule in rules:
             if rule.query:
+                # compiled once, then run for every package or configuration
+                query = self._compile(rule)
+                if query is None:
+                    continue
                 if rule.scope == "package":
-                    pkg_rules.append(rule)
+                    pkg_rules.append((rule, query))
                 elif rule.scope == "configuration":
-                    config_rules.append(rule)
+                    config_rules.append((rule, query))
                 else:
-                    other_rules.append(rule)
+                    other_rules.append((rule, query))
         self._execute_pkg_queries(pkg_rules, reports)
         self._execute_config_queries(config_rules, reports)
-        for rule in other_rules:
-            self._execute(rule, self.data, reports, None)
+        for rule, query in other_rules:
+            self._execute(rule, query, self.data, reports, None)
+
+    def _compile(self, rule):
+        try:
+            return self.pyflwor(rule.query)
+        except SyntaxError as e:
+            self.log.error("SyntaxError on query %s: %s", rule.id, e)
+            return None
 
     def _execute_pkg_queries(self, rules, reports):
         data = dict(self.query_data)
@@ -285,8 +296,8 @@ class QueryEngine(LoggingObject):
             data["files"] = pkg.source_files
             data["nodes"] = pkg.nodes
             location = pkg.location
-            for rule in rules:
-                self._execute(rule, data, reports, location)
+            for rule, query in rules:
+                self._execute(rule, query, data, reports, location)
 
     def _execute_config_queries(self, rules, reports):
         data = dict(self.query_data)
@@ -298,25 +309,22 @@ class QueryEngine(LoggingObject):
             data["services"] = config.services
             data["parameters"] = config.parameters
             location = config.location
-            for rule in rules:
-                self._execute(rule, data, reports, location)
-
-    def _execute(self, rule, data, reports, default_location):
-        try:
-            result = self.pyflwor(rule.query, data)
-        except SyntaxError as e:
-            self.log.error("SyntaxError on query %s: %s", rule.id, e)
-        else:
-            # result can be of types:
-            # - pyflwor.OrderedSet.OrderedSet<object> for Path queries
-            # - tuple<object> for FLWR queries single return
-            # - tuple<tuple<object>> for FLWR queries multi return
-            # - tuple<dict<str, object>> for FLWR queries named return
-            # NOTE: sometimes 'object' can be a tuple or dict...
-            self.log.info("Query %s found %d matches.", rule.id, len(result))
-            for match in result:
-                self.log.debug("Query %s found %s", rule.id, match)
-                self._report(rule, match, reports, default_location)
+            for rule, query in rules:
+                self._execute(rule, query, data, reports, location)
+
+    def _execute(self, rule, query, data, reports, default_location):
+        # syntax errors are found when the query is compiled
+        result = query(data)
+        # result can be of types:
+        # - pyflwor.OrderedSet.OrderedSet<object> for Path queries
+        # - tuple<object> for FLWR queries single return
+        # - tuple<tuple<object>> for FLWR queries multi return
+        # - tuple<dict<str, object>> for FLWR queries named return
+        # NOTE: sometimes 'object' can be a tuple or dict...
+        self.log.info("Query %s found %d matches.", rule.id, len(result))
+        for match in result:
+            self.log.debug("Query %s found %s", rule.id, match)
+            self._report(rule, match, reports, default_location)
 
     def _report(self, rule, match, reports, default_location):
         details = ""
@@ -0,0 +1,293 @@
+
+#Copyright (c) 2017 Andre Santos
+#
+#Permission is hereby granted, free of charge, to any person obtaining a copy
+#of this software and associated documentation files (the "Software"), to deal
+#in the Software without restriction, including without limitation the rights
+#to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#copies of the Software, and to permit persons to whom the Software is
+#furnished to do so, subject to the following conditions:
+
+#The above copyright notice and this permission notice shall be included in
+#all copies or substantial portions of the Software.
+
+#THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+#THE SOFTWARE.
+
+###############################################################################
+# Imports
+###############################################################################
+
+import cPickle
+import logging
+import marshal
+import sqlite3
+
+
+###############################################################################
+# Utility
+###############################################################################
+
+class LoggingObject(object):
+    log = logging.getLogger(__name__)
+
+
+###############################################################################
+# SQLite Cache Base
+###############################################################################
+
+class SqliteCache(LoggingObject):
+    """Base class for persistent caches stored in a SQLite file.
+    Subclasses define SCHEMA_VERSION and SCHEMA (a list of statements).
+    If the stored version differs, all tables are dropped and recreated.
+    Caches are best effort: any database error disables the cache."""
+    SCHEMA_VERSION = 0
+    SCHEMA = ()
+    TABLES = ()
+
+    def __init__(self, path, readonly=False):
+        self.path = path
+        self.readonly = readonly
+        self._db = None
+        self._pending = []
+
+    def open(self):
+        if self._db is None:
+            try:
+                self._db = sqlite3.connect(self.path, timeout=30.0)
+                self._db.text_factory = str
+                if not self.readonly:
+                    self._check_schema()
+            except sqlite3.Error as e:
+                self.log.warning("Could not open cache %s: %s", self.path, e)
+                self._db = None
+        return self._db is not None
+
+    def pending(self):
+        """Returns and forgets the records waiting to be written."""
+        records = list(self._pending)
+        del self._pending[:]
+        return records
+
+    def merge(self, records):
+        """Queues records obtained from another instance (e.g., a worker)."""
+        self._pending.extend(records)
+
+    def commit(self):
+        if self._db is None or self.readonly or not self._pending:
+            del self._pending[:]
+            return
+        try:
+            with self._db:
+                self._write(self._pending)
+        except sqlite3.Error as e:
+            self.log.warning("Could not update cache %s: %s", self.path, e)
+        del self._pending[:]
+
+    def close(self):
+        if self._db is not None:
+            self.commit()
+            self._db.close()
+            self._db = None
+
+    def _query(self, sql, args):
+        if self._db is None:
+            return None
+        try:
+            return self._db.execute(sql, args).fetchone()
+        except sqlite3.Error as e:
+            self.log.debug("Cache lookup failed in %s: %s", self.path, e)
+            return None
+
+    def _write(self, records):
+        raise NotImplementedError()
+
+    def _check_schema(self):
+        version = self._db.execute("PRAGMA user_version").fetchone()[0]
+        if version == self.SCHEMA_VERSION:
+            return
+        self.log.debug("Resetting cache %s (version %s)", self.path, version)
+        with self._db:
+            for table in self.TABLES:
+                self._db.execute("DROP TABLE IF EXISTS " + table)
+            for statement in self.SCHEMA:
+                self._db.execute(statement)
+            self._db.execute("PRAGMA user_version = %d" % self.SCHEMA_VERSION)
+
+
+###############################################################################
+# File Statistics Index
+###############################################################################
+
+class FileStatsIndex(SqliteCache):
+    """Persistent index of SourceFile statistics.
+    Entries are keyed by absolute path, modification time and size,
+    so that any change to a file results in a cache miss.
+    Records are (language, lines, sloc, digest, ignored_lines)."""
+    SCHEMA_VERSION = 4
+    TABLES = ("files",)
+    SCHEMA = (
+        "CREATE TABLE files (path TEXT PRIMARY KEY, mtime REAL, "
+        "size INTEGER, data BLOB)",
+    )
+
+    def get(self, path, mtime, size):
+        row = self._query("SELECT data FROM files WHERE path = ? "
+                          "AND mtime = ? AND size = ?", (path, mtime, size))
+        if row is None:
+            return None
+        return marshal.loads(str(row[0]))
+
+    def put(self, path, source, ignored_lines):
+        self._pending.append((path, source.timestamp, source.size,
+            (source.language, source.lines, source.sloc, source.digest,
+             ignored_lines)))
+
+    def _write(self, records):
+        self._db.executemany(
+            "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)",
+            ((path, mtime, size, sqlite3.Binary(marshal.dumps(data)))
+             for path, mtime, size, data in records))
+
+
+###############################################################################
+# Node Parse Cache
+###############################################################################
+
+class ParseCache(SqliteCache):
+    """Persistent cache of parsed nodes, with one record per node.
+    Records are the dictionaries produced by Node.to_JSON_object().
+    The names of nodes whose records were found to be valid are kept
+    in 'reused', so that only new or changed nodes are written back."""
+    SCHEMA_VERSION = 1
+    TABLES = ("nodes",)
+    SCHEMA = (
+        "CREATE TABLE nodes (name TEXT PRIMARY KEY, data BLOB)",
+    )
+
+    def __init__(self, path, readonly=False):
+        SqliteCache.__init__(self, path, readonly=readonly)
+        self.reused = set()
+
+    def get(self, name):
+        row = self._query("SELECT data FROM nodes WHERE name = ?", (name,))
+        if row is None:
+            return None
+        return marshal.loads(str(row[0]))
+
+    def put(self, name, datum):
+        self._pending.append((name, datum))
+
+    def _write(self, records):
+        self._db.executemany(
+            "INSERT OR REPLACE INTO nodes VALUES (?, ?)",
+            ((name, sqlite3.Binary(marshal.dumps(datum)))
+             for name, datum in records))
+
+
+###############################################################################
+# Launch Tree Cache
+###############################################################################
+
+class LaunchTreeCache(SqliteCache):
+    """Persistent cache of parsed launch files.
+    Entries are keyed by absolute path, modification time and size.
+    Records are (tree, error, packages), where 'error' is the message of
+    a failed parse and 'packages' lists the (name, path) pairs of the
+    packages found by $(find) substitutions, so that records can be
+    discarded when a package moves."""
+    SCHEMA_VERSION = 1
+    TABLES = ("launch",)
+    SCHEMA = (
+        "CREATE TABLE launch (path TEXT PRIMARY KEY, mtime REAL, "
+        "size INTEGER, data BLOB)",
+    )
+
+    def get(self, path, mtime, size):
+        row = self._query("SELECT data FROM launch WHERE path = ? "
+                          "AND mtime = ? AND size = ?", (path, mtime, size))
+        if row is None:
+            return None
+        try:
+            return cPickle.loads(str(row[0]))
+        except Exception as e:
+            # e.g., the launch tag classes have changed since
+            self.log.debug("Discarding cached launch tree %s: %s", path, e)
+            return None
+
+    def put(self, path, mtime, size, tree, error, packages):
+        self._pending.append((path, mtime, size, (tree, error, packages)))
+
+    def _write(self, records):
+        self._db.executemany(
+            "INSERT OR REPLACE INTO launch VALUES (?, ?, ?, ?)",
+            ((path, mtime, size, sqlite3.Binary(
+                cPickle.dumps(data, cPickle.HIGHEST_PROTOCOL)))
+             for path, mtime, size, data in records))
+
+
+###############################################################################
+# CMake Cache
+###############################################################################
+
+class CMakeCache(SqliteCache):
+    """Persistent cache of CMake files, at two levels.
+    Parse trees are keyed by absolute path, modification time and size.
+    The targets of a top-level CMakeLists.txt are keyed by path and by
+    a digest of the parser inputs. Target records are
+    (files, libraries, executables), where 'files' lists the
+    (path, mtime, size) of every CMake file that was parsed, so that
+    records can be discarded when any of them changes."""
+    SCHEMA_VERSION = 1
+    TABLES = ("trees", "targets")
+    SCHEMA = (
+        "CREATE TABLE trees (path TEXT PRIMARY KEY, mtime REAL, "
+        "size INTEGER, data BLOB)",
+        "CREATE TABLE targets (path TEXT PRIMARY KEY, digest TEXT, "
+        "data BLOB)",
+    )
+
+    def get_tree(self, path, mtime, size):
+        row = self._query("SELECT data FROM trees WHERE path = ? "
+                          "AND mtime = ? AND size = ?", (path, mtime, size))
+        if row is None:
+            return None
+        return marshal.loads(str(row[0]))
+
+    def put_tree(self, path, mtime, size, tree):
+        self._pending.append(("trees", path, mtime, size, tree))
+
+    def get_targets(self, path, digest):
+        row = self._query("SELECT data FROM targets WHERE path = ? "
+                          "AND digest = ?", (path, digest))
+        if row is None:
+            return None
+        try:
+            return cPickle.loads(str(row[0]))
+        except Exception as e:
+            # e.g., the target classes have changed since
+            self.log.debug("Discarding cached CMake targets %s: %s", path, e)
+            return None
+
+    def put_targets(self, path, digest, files, libraries, executables):
+        self._pending.append(("targets", path, digest,
+                              (files, libraries, executables)))
+
+    def _write(self, records):
+        trees = [record[1:] for record in records if record[0] == "trees"]
+        targets = [record[1:] for record in records
+                   if record[0] == "targets"]
+        self._db.executemany(
+            "INSERT OR REPLACE INTO trees VALUES (?, ?, ?, ?)",
+            ((path, mtime, size, sqlite3.Binary(marshal.dumps(tree)))
+             for path, mtime, size, tree in trees))
+        self._db.executemany(
+            "INSERT OR REPLACE INTO targets VALUES (?, ?, ?)",
+            ((path, digest, sqlite3.Binary(
+                cPickle.dumps(data, cPickle.HIGHEST_PROTOCOL)))
+             for path, digest, data in targets))
@@ -35,7 +35,9 @@
 ###############################################################################
 
 from distutils.version import LooseVersion
+import fnmatch
 import glob
+import hashlib
 import logging
 import itertools
 import os
@@ -55,7 +57,7 @@ class LoggingObject(object):
 ###############################################################################
 
 class IncompleteStatementError(Exception):
-    """Exception raised by parse_line when not given a full valid statement"""
+    """Exception raised by the tokenizer when not given a full valid statement"""
     pass
 
 class CMakeGrammar(object):
@@ -75,10 +77,6 @@ class CMakeGrammar(object):
             """.split())
         + r")")
 
-    _reFuncName = r"(?x) (?P<FuncName> [\w\d]+)"
-
-    _reArgs = r"(?x) (?P<Args> (\S ((\s)*\S)*))"
-
     _reArg = r"""(?x) (?:
                  \(|
                  \)|
@@ -87,33 +85,7 @@ class CMakeGrammar(object):
                  '(?:\\.|[^'\\])*')
              """
 
-    _reComment = r"(?x) (?P<Comment> (?<!\\) \# (?: [^\S\n]* \S+)*)"
-
-    _reCommandStart = _reFuncName + r"\s* \("
-
-    _reCommandEnd = r"\)"
-
-    _reFullLine = ( r"^\s*(?P<FullLine>"
-                + r"("
-                + _reCommandStart
-                + r"\s*"
-                + r"("
-                + _reArgs
-                + r")?"
-                + r"\s*"
-                + _reCommandEnd
-                + r")?"
-                + r"\s*"
-                + r"("
-                + _reComment
-                + r")?"
-                + r")\s*$")
-
-    _reMLChunk = ( r"(?mx)(" + _reComment + "\n|" + _reArg + ")")
-
-    reFullLine = re.compile(_reFullLine, (re.IGNORECASE
-                                          | re.VERBOSE
-                                          | re.MULTILINE))
+    reArg = re.compile(_reArg)
 
     _blockTagsDict = {
         "foreach": ("endforeach",),
@@ -125,13 +97,6 @@ class CMakeGrammar(object):
         "while": ("endwhile",)
     }
 
-    _reBlockBeginnings = (r"(?ix)"
-                          + r"(?P<BlockBeginnings>"
-                          + "|".join(_blockTagsDict.keys())
-                          + r")")
-
-    reBlockBeginnings = re.compile(_reBlockBeginnings, re.IGNORECASE)
-
     dReBlockTagsDict = dict([
         (beginning,
          re.compile(r"(?ix)^(?P<BlockEnding>"
@@ -140,43 +105,145 @@ class CMakeGrammar(object):
         ) for beginning, ends in _blockTagsDict.iteritems()
     ])
 
-    @staticmethod
-    def parse_line(line):
-        # Handle EOF sentry: a "None" entry returns an all-None tuple
-        if line is None:
-            return (None, None, None)
-        m = CMakeGrammar.reFullLine.match(line)
-        if m is None:
-            raise IncompleteStatementError(line)
-        FuncName, Args, Comment = m.group("FuncName", "Args", "Comment")
-        if Args is not None and re.search(r"\n", Args) is not None:
-            units = re.findall(CMakeGrammar._reMLChunk, Args)
-            MLArgs = []
-            MLComment = []
-            for unit in units:
-                if re.match(CMakeGrammar._reComment, unit[0]):
-                    MLComment.append(unit[0])
-                elif re.match(CMakeGrammar._reArg, unit[0]):
-                    MLArgs.append(unit[0])
-            Args = " ".join(MLArgs)
-            if Comment is not None:
-                MLComment.append(Comment)
-            if len(MLComment) > 0:
-                Comment = "\n".join(MLComment)
-            else:
-                Comment = None
-        if FuncName is None:
-            FuncName = ""
-        return (FuncName, Args, Comment)
-
     @staticmethod
     def split_args(args):
-        return re.findall(CMakeGrammar._reArg, args)
+        return CMakeGrammar.reArg.findall(args)
 
 # sanity check the comprehension above
 assert len(CMakeGrammar._blockTagsDict) == len(CMakeGrammar.dReBlockTagsDict)
 
 
+class CMakeTokenizer(object):
+    """Splits CMake code into (function, arguments, comment) statements,
+    in a single pass over the text.
+    Each statement is a command invocation, plus the rest of the line
+    where the invocation ends, or a line without commands, in which case
+    the function is an empty string.
+    Arguments are the text between parentheses, without comments, and
+    are None when empty. Arguments that span multiple lines are joined
+    in a single line. Comments are None if the statement has none."""
+
+    _reName = re.compile(r"[A-Za-z0-9_]+")
+    _reSpace = re.compile(r"[^\S\n]*")
+    _reSpaceNewline = re.compile(r"\s*")
+    # characters that need attention inside the parentheses of a command
+    _reArgSpecial = re.compile(r'[()"#\\\[]')
+    _reQuoted = re.compile(r'"(?:\\.|[^"\\])*"', re.DOTALL)
+    _reBracketOpen = re.compile(r"\[(=*)\[")
+
+    def __init__(self, text):
+        self.lines = text.splitlines()
+        self.text = "\n".join(self.lines)
+        self.pos = 0
+
+    def tokenize(self):
+        statements = []
+        if not self.lines:
+            return statements
+        n = len(self.text)
+        while True:
+            statements.append(self._statement())
+            if self.pos >= n:
+                return statements
+            assert self.text[self.pos] == "\n"
+            self.pos += 1
+
+    def _statement(self):
+        text = self.text
+        start = self.pos
+        self.pos = self._reSpace.match(text, self.pos).end()
+        func = ""
+        args = None
+        comments = []
+        match = self._reName.match(text, self.pos)
+        if match:
+            func = match.group()
+            self.pos = self._reSpaceNewline.match(text, match.end()).end()
+            if not text.startswith("(", self.pos):
+                raise IncompleteStatementError(self._line(start))
+            args = self._arguments(start, comments)
+            self.pos = self._reSpace.match(text, self.pos).end()
+        if text.startswith("#", self.pos):
+            comments.append(self._comment(start))
+            self.pos = self._reSpace.match(text, self.pos).end()
+        if self.pos < len(text) and text[self.pos] != "\n":
+            raise IncompleteStatementError(self._line(start))
+        return (func, args, "\n".join(comments) if comments else None)
+
+    def _arguments(self, start, comments):
+        text = self.text
+        self.pos += 1
+        depth = 1
+        segments = []
+        segment = self.pos
+        while True:
+            match = self._reArgSpecial.search(text, self.pos)
+            if match is None:
+                raise IncompleteStatementError(self._line(start))
+            c = match.group()
+            i = match.start()
+            if c == "(":
+                depth += 1
+                self.pos = i + 1
+            elif c == ")":
+                depth -= 1
+                self.pos = i + 1
+                if depth == 0:
+                    segments.append(text[segment:i])
+                    break
+            elif c == '"':
+                match = self._reQuoted.match(text, i)
+                if match is None:
+                    raise IncompleteStatementError(self._line(start))
+                self.pos = match.end()
+            elif c == "\\":
+                self.pos = i + 2
+            elif c == "[":
+                self.pos = self._bracket(i, start)
+            else:
+                assert c == "#"
+                segments.append(text[segment:i])
+                self.pos = i
+                comments.append(self._comment(start))
+                segment = self.pos
+        args = "".join(segments).strip()
+        if not args:
+            return None
+        if "\n" in args:
+            args = " ".join(CMakeGrammar.split_args(args))
+        return args
+
+    def _comment(self, start):
+        # line comments do not include the line ending
+        text = self.text
+        i = self.pos
+        assert text[i] == "#"
+        end = self._bracket(i + 1, start)
+        if end == i + 2:
+            end = text.find("\n", i)
+            if end < 0:
+                end = len(text)
+            self.pos = end
+            return text[i:end].rstrip()
+        self.pos = end
+        return text[i:end]
+
+    def _bracket(self, i, start):
+        # returns the end of a bracket argument, or i + 1 if there is none
+        match = self._reBracketOpen.match(self.text, i)
+        if match is None:
+            return i + 1
+        close = "]" + match.group(1) + "]"
+        end = self.text.find(close, match.end())
+        if end < 0:
+            raise IncompleteStatementError(self._line(start))
+        return end + len(close)
+
+    def _line(self, start):
+        end = self.text.find("\n", self.pos)
+        return self.text[start:end] if end >= 0 else self.text[start:]
+
+
 ###############################################################################
 # CMake Parser
 ###############################################################################
@@ -184,20 +251,16 @@ assert len(CMakeGrammar._blockTagsDict) == len(CMakeGrammar.dReBlockTagsDict)
 class UnclosedChildBlockError(Exception):
     pass
 
-class InputExhaustedError(Exception):
-    pass
-
 
 class ParseInput():
     """Class providing an iterable interface to the parser's input"""
 
-    def __init__(self, strdata):
-        self._data = strdata.splitlines()
+    def __init__(self, statements):
+        self._data = list(statements)
         # Add a None to the end as a sentry.
         self._data.append(None)
-        self._lineindex = 0
-        self.alldone = False
-        self.gotline = False
+        self._index = 0
+        self.gotstatement = False
         self.alreadyseen = False
 
     def __iter__(self):
@@ -205,43 +268,19 @@ class ParseInput():
         return self
 
     def next(self):
-        """Return the current line each time we are iterated.
-        We don't go to the next line unless we've been accepted."""
-
-        # Will always hit this condition if all works well
-        if self._lineindex == len(self._data):
-            self.alldone = True
+        """Return the current statement each time we are iterated.
+        We don't go to the next statement unless we've been accepted."""
+        if self._index == len(self._data):
             raise StopIteration()
-
-        # If we break, break big
-        assert self._lineindex < len(self._data)
-
-        # OK, we can actually return the data now
-        self.alreadyseen = self.gotline
-        self.gotline = True
-        return self._data[self._lineindex]
+        self.alreadyseen = self.gotstatement
+        self.gotstatement = True
+        return self._data[self._index]
 
     def accept(self):
-        """Signal that we've processed this line and should go to the next"""
-
-        # We shouldn't accept a line we haven't even seen
-        assert self.gotline
-
-        self._lineindex = self._lineindex + 1
-        self.gotline = False
-
-    def merge(self):
-        # Don't want to merge current line with the next if we don't
-        # know what the current line is
-        assert self.gotline
-
-        ln = self._lineindex
-        if len(self._data) <= ln + 2:
-            # we want 2 - one more text line, and the EOF sentinel
-            raise InputExhaustedError()
-        next_line = self._data.pop(ln + 1)
-        self._data[ln] = self._data[ln] + "\n" + next_line
-        return self._data[ln]
+        """Signal that we've processed this statement and should go on"""
+        assert self.gotstatement
+        self._index += 1
+        self.gotstatement = False
 
 
 class CMakeParser():
@@ -251,7 +290,8 @@ class CMakeParser():
 
     def parse(self, filename):
         with open(filename, "r") as cmakefile:
-            self.input = ParseInput(cmakefile.read())
+            tokenizer = CMakeTokenizer(cmakefile.read())
+        self.input = ParseInput(tokenizer.tokenize())
         self.parsetree = self.parse_block_children(None)
         if self.parsetree is None:
             self.parsetree = []
@@ -259,36 +299,27 @@ class CMakeParser():
     def parse_block_children(self, startTag):
         if startTag is None:
             isEnder = lambda x: (x is None)
-        elif CMakeGrammar.reBlockBeginnings.match(startTag):
+        elif startTag.lower() in CMakeGrammar.dReBlockTagsDict:
             endblock = CMakeGrammar.dReBlockTagsDict[startTag.lower()]
             isEnder = endblock.match
         else:
             return None
 
         block = []
-        for line in self.input:
-            while True:
-                try:
-                    func, args, comment = CMakeGrammar.parse_line(line)
-                except IncompleteStatementError as e:
-                    try:
-                        line = self.input.merge()
-                    except InputExhaustedError as iee:
-                        raise IncompleteStatementError(line)
-                else:
-                    break
-
-            if startTag is None and isEnder(func):
-                return block
-            elif (func is not None and isEnder(func)
-                    and not self.input.alreadyseen):
+        for statement in self.input:
+            if statement is None:
+                if startTag is None:
+                    return block
+                break
+            func, args, comment = statement
+            # a statement that ended a child block belongs to this one
+            if isEnder(func) and not self.input.alreadyseen:
                 return block
 
             # Not an ender, so we accept this child.
             self.input.accept()
             children = self.parse_block_children(func)
-            statement = (func, args, comment, children)
-            block.append(statement)
+            block.append((func, args, comment, children))
 
         # If we make it this far, we never found our Ender.
         raise UnclosedChildBlockError()
@@ -382,6 +413,92 @@ class BuildTarget(object):
         # TODO elif prop == "<CONFIG>_OUTPUT_NAME":
 
 
+class FileIndex(object):
+    """Expands glob expressions for the files of a package using the list
+    of files found when the package was indexed, rather than listing
+    directories again. Files that were not indexed are not found, as they
+    would not be source files of any node. Expressions outside the package
+    directory are expanded on the file system. Results are memoized."""
+
+    def __init__(self, root, paths = None):
+        self.root = root
+        # each directory is a pair (subdirectories, files)
+        self._tree = None
+        if paths is not None:
+            self._tree = ({}, [])
+            prefix = len(root) + len(os.sep)
+            for path in paths:
+                if path.startswith(root + os.sep):
+                    self._add(path[prefix:].split(os.sep))
+        self._results = {}
+
+    def glob(self, pattern, recurse = False):
+        """Returns the sorted paths that match an absolute pattern.
+        If recurse is set, the last component of the pattern matches
+        files in all subdirectories, as in CMake's GLOB_RECURSE."""
+        key = (pattern, recurse)
+        result = self._results.get(key)
+        if result is None:
+            if (self._tree is not None
+                    and pattern.startswith(self.root + os.sep)):
+                parts = pattern[len(self.root) + len(os.sep):].split(os.sep)
+                result = sorted(self._glob(parts, recurse))
+            else:
+                result = sorted(self._glob_files(pattern, recurse))
+            self._results[key] = result
+        return result
+
+    def _add(self, parts):
+        node = self._tree
+        for part in parts[:-1]:
+            node = node[0].setdefault(part, ({}, []))
+        node[1].append(parts[-1])
+
+    def _glob(self, parts, recurse):
+        matches = [(self.root, self._tree)]
+        for part in parts[:-1]:
+            matches = [(os.path.join(path, name), node[0][name])
+                       for path, node in matches
+                       for name in self._filter(node[0], part)]
+        last = parts[-1]
+        for path, node in matches:
+            if recurse:
+                stack = [(path, node)]
+                while stack:
+                    path, node = stack.pop()
+                    for name in fnmatch.filter(node[1], last):
+                        yield os.path.join(path, name)
+                    for name, child in node[0].iteritems():
+                        stack.append((os.path.join(path, name), child))
+            else:
+                for name in self._filter(node[1], last):
+                    yield os.path.join(path, name)
+                for name in self._filter(node[0], last):
+                    yield os.path.join(path, name)
+
+    @staticmethod
+    def _filter(names, pattern):
+        if not glob.has_magic(pattern):
+            return (pattern,) if pattern in names else ()
+        if not pattern.startswith("."):
+            # same as glob, hidden files are only matched explicitly
+            names = [name for name in names if not name.startswith(".")]
+        return fnmatch.filter(names, pattern)
+
+    @staticmethod
+    def _glob_files(pattern, recurse):
+        if not recurse:
+            return glob.glob(pattern)
+        dirname, pattern = os.path.split(pattern)
+        dirs = glob.glob(dirname) if glob.has_magic(dirname) else [dirname]
+        matches = []
+        for dirname in dirs:
+            for path, _, filenames in os.walk(dirname):
+                matches.extend(os.path.join(path, name)
+                               for name in fnmatch.filter(filenames, pattern))
+        return matches
+
+
 class RosCMakeParser(LoggingObject):
     @staticmethod
     def _get_option_args(args, option):
@@ -392,7 +509,8 @@ class RosCMakeParser(LoggingObject):
         except ValueError:
             return []
 
-    def __init__(self, srcdir, bindir, pkgs = None, env = None, vars = None):
+    def __init__(self, srcdir, bindir, pkgs = None, env = None, vars = None,
+                 cache = None):
         self.parser = CMakeParser()
         self.source_dir = srcdir
         self.binary_dir = bindir
@@ -400,22 +518,42 @@ class RosCMakeParser(LoggingObject):
         self.variables = vars if not vars is None else {}
         self.environment = env if not env is None else {}
         self.variables["CMAKE_BINARY_DIR"] = bindir
+        self.cache = cache
+        self.file_index = None
+        # expanded arguments, while variables are unchanged
+        self._values = {}
+        # (path, mtime, size) of the CMake files parsed, with subdirectories
+        self._files = []
         self._reset()
 
     _CONTROL_FLOW = ("if", "else", "elseif", "foreach", "while")
 
-    def parse(self, cmakelists, toplevel = True):
+    def parse(self, cmakelists, toplevel = True, sources = None):
+        """Parses a CMakeLists.txt and its subdirectories.
+        With a cache, parse trees are reused while files are unchanged.
+        If 'sources' lists the files of the package as well, file(GLOB)
+        is answered from that list, and the resulting targets are also
+        reused while the inputs of the parser are the same, since targets
+        depend on which files exist."""
         self.directory = os.path.dirname(cmakelists)
         if toplevel:
             self.directory = os.path.abspath(self.directory)
             self.variables["CMAKE_SOURCE_DIR"] = self.directory
+            self.file_index = FileIndex(self.directory, sources)
         self.variables["CMAKE_CURRENT_SOURCE_DIR"] = self.directory
         self.variables["CMAKE_CURRENT_LIST_FILE"] = cmakelists
         self.variables["CMAKE_CURRENT_LIST_DIR"] = self.directory
         self.variables["CMAKE_CURRENT_BINARY_DIR"] = (
             self.binary_dir + self.directory[len(self.source_dir):]
         )
-        self.parser.parse(cmakelists)
+        self._values.clear()
+        digest = None
+        if toplevel and self.cache is not None and sources is not None:
+            digest = self._digest(sources)
+            if self._load_targets(cmakelists, digest):
+                return
+            environment = dict(self.environment)
+        self._parse_tree(cmakelists)
         for stmt in self.parser.parsetree:
             command = stmt[0].lower()
             args = CMakeGrammar.split_args(stmt[1]) if stmt[1] else []
@@ -430,11 +568,60 @@ class RosCMakeParser(LoggingObject):
                 parser = RosCMakeParser(self.source_dir, self.binary_dir,
                                           pkgs = self.packages,
                                           env = self.environment,
-                                          vars = dict(self.variables))
+                                          vars = dict(self.variables),
+                                          cache = self.cache)
+                parser._files = self._files
+                parser.file_index = self.file_index
                 parser.parse(path, toplevel = False)
                 self._merge(parser)
+                # the environment is shared with subdirectories
+                self._values.clear()
         if toplevel:
             self._link_targets()
+        # set(ENV{...}) affects the packages parsed afterwards
+        if digest is not None and self.environment == environment:
+            self.cache.put_targets(cmakelists, digest, self._files,
+                                   self.libraries, self.executables)
+
+    def _parse_tree(self, cmakelists):
+        if self.cache is None:
+            self.parser.parse(cmakelists)
+            return
+        stats = os.stat(cmakelists)
+        self._files.append((cmakelists, stats.st_mtime, stats.st_size))
+        tree = self.cache.get_tree(cmakelists, stats.st_mtime, stats.st_size)
+        if tree is None:
+            self.parser.parse(cmakelists)
+            self.cache.put_tree(cmakelists, stats.st_mtime, stats.st_size,
+                                self.parser.parsetree)
+        else:
+            self.log.debug("Reusing parse tree of %s", cmakelists)
+            self.parser.parsetree = tree
+
+    def _load_targets(self, cmakelists, digest):
+        record = self.cache.get_targets(cmakelists, digest)
+        if record is None:
+            return False
+        files, libraries, executables = record
+        for path, mtime, size in files:
+            try:
+                stats = os.stat(path)
+            except OSError:
+                return False
+            if stats.st_mtime != mtime or stats.st_size != size:
+                return False
+        self.log.debug("Reusing CMake targets of %s", cmakelists)
+        self.libraries = libraries
+        self.executables = executables
+        return True
+
+    def _digest(self, sources):
+        h = hashlib.sha1()
+        h.update(repr(sorted(self.environment.iteritems())))
+        h.update(repr(sorted(self.variables.iteritems())))
+        h.update(repr(sorted(self.packages)))
+        h.update(repr(sorted(sources)))
+        return h.hexdigest()
 
     def _analyse_control_flow(self, command, args, children):
         if command == "else":
@@ -451,8 +638,13 @@ class RosCMakeParser(LoggingObject):
                 else:
                     self._analyse_command(child_command, child_args)
 
+    # commands that change variables or the environment
+    _SCOPE_COMMANDS = ("project", "set", "unset", "find_package", "file")
+
     def _analyse_command(self, command, args):
         args = [self._argument(arg) for arg in args]
+        if command in self._SCOPE_COMMANDS:
+            self._values.clear()
         if command == "project" and args[0]:
             self.project = args[0]
             self.variables["PROJECT_NAME"] = args[0]
@@ -685,17 +877,26 @@ class RosCMakeParser(LoggingObject):
             data[i] = os.path.join(self.directory, data[i])
             i += 1
 
+    _GLOB_OPTIONS = {"RELATIVE": 2, "LIST_DIRECTORIES": 2,
+                     "CONFIGURE_DEPENDS": 1, "FOLLOW_SYMLINKS": 1}
+
     def _process_file(self, args):
-        if args[0] == "GLOB":
+        if args[0] == "GLOB" or args[0] == "GLOB_RECURSE":
+            recurse = args[0] == "GLOB_RECURSE"
             var = args[1]
-            if args[2] == "RELATIVE":
-                args = args[4:]
-            else:
-                args = args[2:]
+            args = args[2:]
             matches = []
-            for expr in args:
-                expr = self.directory + os.sep + expr
-                matches.extend(glob.glob(expr))
+            i = 0
+            while i < len(args):
+                skip = self._GLOB_OPTIONS.get(args[i])
+                if skip:
+                    i += skip
+                    continue
+                expr = os.path.normpath(os.path.join(self.directory, args[i]))
+                if self.file_index is None:
+                    self.file_index = FileIndex(self.directory)
+                matches.extend(self.file_index.glob(expr, recurse = recurse))
+                i += 1
             self.variables[var] = ";".join(matches)
 
     _TRUTH_CONSTANTS = ("1", "ON", "TRUE", "Y", "YES")
@@ -836,34 +1037,75 @@ class RosCMakeParser(LoggingObject):
             return "FALSE"
 
     def _argument(self, arg):
+        program = self._programs.get(arg)
+        if program is None:
+            program = self._compile(arg)
+        if isinstance(program, str):
+            return program
+        value = self._values.get(arg)
+        if value is None:
+            value = self._values[arg] = self._expand(program)
+        return value
+
+    def _expand(self, program):
+        # references are evaluated innermost first, so that their values
+        # can be part of the names of the enclosing references
+        stack = [[]]
+        for op, text in program:
+            if op is self._TEXT:
+                stack[-1].append(text)
+            elif op is self._OPEN:
+                stack.append([])
+            else:
+                var = "".join(stack.pop()).replace('"', "")
+                data = self.environment if op is self._ENV else self.variables
+                stack[-1].append(data.get(var, ""))
+        return "".join(stack[0]).replace('"', "")
+
+    _TEXT = "text"
+    _OPEN = "open"
+    _VARIABLE = "var"
+    _ENV = "env"
+    _REFERENCE = re.compile(r"\$ENV\{|\$\{|\{|\}")
+
+    # argument text -> str (without references) or tuple of (op, text)
+    _programs = {}
+
+    @classmethod
+    def _compile(cls, arg):
+        if not "$" in arg:
+            program = cls._programs[arg] = arg.replace('"', "")
+            return program
+        program = []
+        # [index of the open op, kind of reference, nested braces]
+        references = []
         i = 0
-        n = len(arg)
-        while i < n and arg[i] != "$":
-            i += 1
-        if i == n:
-            return arg.replace('"', "")
-        prefix = arg[:i]
-        suffix = self._maybe_variable(arg[i:])
-        return (prefix + suffix).replace('"', "")
-
-    def _maybe_variable(self, arg):
-        assert arg[0] == "$"
-        is_env_var = arg.startswith("$ENV{")
-        if arg.startswith("${") or is_env_var:
-            value, k = self._variable(arg, is_env_var)
-            suffix = self._argument(arg[k:])
-            return value + suffix
-        suffix = self._argument(arg[1:])
-        return "$" + suffix
-
-    def _variable(self, arg, env):
-        var, k = self.parser.read_until_match(arg, chars = "{}", start = 4 if env else 1)
-        var = self._argument(var)
-        if env:
-            value = self.environment.get(var, "")
-        else:
-            value = self.variables.get(var, "")
-        return (value, k)
+        for match in cls._REFERENCE.finditer(arg):
+            if match.start() > i:
+                program.append((cls._TEXT, arg[i:match.start()]))
+            i = match.end()
+            token = match.group()
+            if token == "{" and references:
+                references[-1][2] += 1
+            elif token == "}" and references:
+                if references[-1][2] > 0:
+                    references[-1][2] -= 1
+                else:
+                    program.append((references.pop()[1], token))
+                    continue
+            elif token == "${" or token == "$ENV{":
+                kind = cls._ENV if token == "$ENV{" else cls._VARIABLE
+                references.append([len(program), kind, 0])
+                program.append((cls._OPEN, token))
+                continue
+            program.append((cls._TEXT, token))
+        if i < len(arg):
+            program.append((cls._TEXT, arg[i:]))
+        # unterminated references are kept as text
+        for index, _, _ in references:
+            program[index] = (cls._TEXT, program[index][1])
+        program = cls._programs[arg] = tuple(program)
+        return program
 
     def _merge(self, other):
         self.include_dirs.extend(other.include_dirs)
@@ -36,11 +36,17 @@
 # Imports
 ###############################################################################
 
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
+import cPickle
+from cStringIO import StringIO
 import logging
+import marshal
 import os
-import re
 import yaml
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
 
 rosparam = None # lazy import
 
@@ -50,7 +56,8 @@ from .launch_parser import (
 )
 from .metamodel import (
     Node, Configuration, RosName, NodeInstance, Parameter, Topic, Service,
-    SourceCondition, TopicPrimitive, ServicePrimitive, ParameterPrimitive
+    SourceCondition, TopicPrimitive, ServicePrimitive, ParameterPrimitive,
+    ResourceCollection
 )
 
 
@@ -62,6 +69,63 @@ class LoggingObject(object):
     log = logging.getLogger(__name__)
 
 
+###############################################################################
+# YAML Documents
+###############################################################################
+
+class _YamlLoader(SafeLoader):
+    pass
+
+
+class YamlDocuments(LoggingObject):
+    """Memo of file contents and parsed YAML documents, used while
+        building configurations. Files are keyed by path and mtime.
+        Documents are stored marshalled, so that every load returns
+        new objects that the caller is free to change.
+    """
+    MAX_ENTRIES = 256
+
+    def __init__(self):
+        self._files = OrderedDict()
+        self._documents = OrderedDict()
+
+    def read(self, path):
+        stats = os.stat(path)
+        key = (stats.st_mtime, stats.st_size)
+        entry = self._files.get(path)
+        if entry is not None and entry[0] == key:
+            return entry[1]
+        with open(path) as f:
+            text = f.read()
+        self._store(self._files, path, (key, text))
+        return text
+
+    def load(self, text):
+        data = self._documents.get(text)
+        if data is not None:
+            return marshal.loads(data)
+    # ----- constructors added to SafeLoader (e.g., by rosparam) also apply
+        constructors = yaml.SafeLoader.yaml_constructors
+        if not _YamlLoader.yaml_constructors is constructors:
+            _YamlLoader.yaml_constructors = constructors
+        value = yaml.load(text, Loader = _YamlLoader)
+        try:
+            data = marshal.dumps(value)
+        except ValueError:
+            return value # e.g., timestamps cannot be marshalled
+        self._store(self._documents, text, data)
+        # same objects on every load, not only after the first one
+        return marshal.loads(data)
+
+    def _store(self, entries, key, value):
+        entries.pop(key, None)
+        entries[key] = value
+        if len(entries) > self.MAX_ENTRIES:
+            entries.popitem(last = False)
+
+yaml_documents = YamlDocuments()
+
+
 ###############################################################################
 # Launch File Analysis
 ###############################################################################
@@ -166,7 +230,7 @@ class LaunchScope(LoggingObject):
         if rosparam is None:
             import rosparam
         try:
-            value = yaml.safe_load(value)
+            value = yaml_documents.load(value)
         except yaml.MarkedYAMLError as e:
             raise ConfigurationError(str(e))
     # ----- try to use given name, namespace or both
@@ -188,13 +252,13 @@ class LaunchScope(LoggingObject):
         # TODO check whether "~p" = "/rosparam/p" is intended or a bug
         ns = self._ns_join(ns or self.private_ns, self.private_ns)
         name = RosName.resolve(name, ns, "/rosparam")
-        param = self.configuration.parameters.get(name)
-        if not param:
+        params = self.configuration.parameters
+    # ----- deleting a namespace deletes every parameter under it
+        if not params.in_namespace(name):
             raise ConfigurationError("missing parameter: " + name)
         if not condition is True or self.conditions:
             return
-        else:
-            self.resources.deleted_params.append(name)
+        params.remove_namespace(name)
 
     def _namespace(self, ns, private = False):
         pns = self.private_ns
@@ -297,7 +361,7 @@ class LaunchScope(LoggingObject):
             # names provided by hints. If there is a hint that matches
             # the name pattern, message type and primitive type, merge.
             self.log.debug("Processing unresolved name with hints.")
-            topics = self._pattern_match(rosname.pattern, rtype, hints)
+            topics = self._pattern_match(rosname, rtype, hints)
             for topic in topics:
                 self.log.debug("Found link to %s from hints.", topic.id)
                 new = topic.remap(RosName(topic.rosname.full,
@@ -354,7 +418,7 @@ class LaunchScope(LoggingObject):
             # names provided by hints. If there is a hint that matches
             # the name pattern, message type and primitive type, merge.
             self.log.debug("Processing unresolved name with hints.")
-            services = self._pattern_match(rosname.pattern, rtype, hints)
+            services = self._pattern_match(rosname, rtype, hints)
             for srv in services:
                 self.log.debug("Found link to %s from hints.", srv.id)
                 new = srv.remap(RosName(srv.rosname.full,
@@ -396,16 +460,11 @@ class LaunchScope(LoggingObject):
                                           location = source_location))
         return links
 
-    def _pattern_match(self, pattern, rtype, collection):
-        candidates = []
-        for resource in collection:
-            self.log.debug("[?] pattern_match: '%s' (%s), '%s' (%s)",
-                           pattern, rtype, resource.rosname.full,
-                           resource.type)
-            if re.match(pattern, resource.rosname.full):
-                if resource.type == rtype:
-                    self.log.debug("[+] found a match")
-                    candidates.append(resource)
+    def _pattern_match(self, rosname, rtype, collection):
+        candidates = [resource for resource in collection.match(rosname)
+                      if resource.type == rtype]
+        self.log.debug("[?] pattern_match: '%s' (%s): %d matches",
+                       rosname.pattern, rtype, len(candidates))
         return candidates
 
     # as seen in roslaunch code, sans a few details
@@ -440,7 +499,7 @@ class LaunchScope(LoggingObject):
             raise ValueError("{} is not a '{}' type".format(value, ptype))
         elif ptype == "yaml":
             try:
-                return yaml.safe_load(value)
+                return yaml_documents.load(value)
             except yaml.parser.ParserError as e:
                 raise ValueError(e)
         else:
@@ -553,14 +612,13 @@ class FutureParamLink(object):
                           self.node.remaps)
         links = []
         if rosname.is_unresolved and self.hints:
-            pattern = rosname.pattern
-            params = self._pattern_match(pattern, collection)
+            params = collection.match(rosname)
             for param in params:
                 links.append(ParameterPrimitive(self.node, param, self.type,
                                                 call_name,
                                                 conditions = self.conditions,
                                                 location = self.source_location))
-            params = self._pattern_match(pattern, self.hints)
+            params = self._pattern_match(rosname, self.hints)
             for param in params:
                 new = param.remap(RosName(param.rosname.full,
                                           remaps = self.node.remaps))
@@ -591,12 +649,14 @@ class FutureParamLink(object):
             if not self.repeats:
                 return
 
-    def _pattern_match(self, pattern, collection):
-        candidates = []
-        for resource in collection:
-            if re.match(pattern, resource.rosname.full):
-                candidates.append(resource)
-        return candidates
+    def _pattern_match(self, rosname, collection):
+        if isinstance(collection, ResourceCollection):
+            return collection.match(rosname)
+        prefix = rosname.prefix
+        pattern = rosname.regex
+        return [resource for resource in collection
+                if resource.rosname.full.startswith(prefix)
+                and pattern.match(resource.rosname.full)]
 
 
 ###############################################################################
@@ -625,16 +685,16 @@ class ConfigurationHints(LoggingObject):
     }
 
     def __init__(self):
-        self.advertise = []
-        self.subscribe = []
-        self.service = []
-        self.client = []
+        self.advertise = ResourceCollection(None)
+        self.subscribe = ResourceCollection(None)
+        self.service = ResourceCollection(None)
+        self.client = ResourceCollection(None)
 
     def topics(self):
-        return self.advertise + self.subscribe
+        return self.advertise.all + self.subscribe.all
 
     def services(self):
-        return self.service + self.client
+        return self.service.all + self.client.all
 
     hint_types = (("advertise", Topic), ("subscribe", Topic),
                   ("service", Service), ("client", Service))
@@ -657,8 +717,8 @@ class ConfigurationHints(LoggingObject):
     # ----- NOTE: we do not remap before using the hints for lookup
                 rosname = RosName(own_name, scope.resolve_ns(ns), pns)
                 cls.log.debug("%s hint: %s", key, rosname.full)
-                getattr(instance, key).append(rcls(scope.configuration, rosname,
-                                                   message_type=msg_type))
+                getattr(instance, key).add(rcls(scope.configuration, rosname,
+                                                message_type=msg_type))
         return instance
 
     def make_missing_links(self, scope):
@@ -796,15 +856,92 @@ class ConfigurationHints(LoggingObject):
         return True
 
 
+class IncludeExpansion(object):
+    """Records the operations applied to the scopes of an included launch
+        file, so that the same inclusion can be replayed on another scope.
+        Operations are [op, scope index, args, creates scope]; the scope
+        given to the constructor has index 0.
+    """
+    def __init__(self, scope):
+        self.operations = []
+        self.pkg_depends = set()
+        self.env_depends = set()
+        self.environment = {}
+        self.reusable = True
+        self._scopes = {id(scope): 0}
+
+    def record(self, op, scope, args):
+        index = self._scopes.get(id(scope), -1) if scope else -1
+        operation = [op, index, args, False]
+        self.operations.append(operation)
+        return operation
+
+    def created(self, operation, scope):
+        if isinstance(scope, LaunchScope):
+            operation[3] = True
+            self._scopes[id(scope)] = len(self._scopes)
+
+    def freeze(self):
+        """Copies the recorded arguments once the included file has been
+            analysed. The arguments of a child scope are only complete
+            after its arg tags, and must not change afterwards.
+        """
+        for operation in self.operations:
+            operation[2] = self.snapshot(operation[2])
+
+    @staticmethod
+    def snapshot(args):
+        # dictionaries (e.g., the arguments of a child scope) are
+        # modified by the scopes that receive them
+        return tuple(dict(a) if isinstance(a, dict) else a for a in args)
+
+
+class IncludeCache(LoggingObject):
+    """Memoizes the expansion of included launch files, keyed by
+        launch file, resolved arguments and whether the include is
+        conditional. Entries are only reused if the environment
+        variables that the expansion depends on have the same values.
+    """
+    PRIMITIVES = (basestring, int, long, float, bool, type(None))
+
+    def __init__(self):
+        self._expansions = {}
+
+    def key(self, launch_file, args, conditions):
+        for value in args.itervalues():
+            if not isinstance(value, self.PRIMITIVES):
+                return None
+        return (launch_file.path, tuple(sorted(args.iteritems())),
+                bool(conditions))
+
+    def get(self, key, environment):
+        if key is None:
+            return None
+        expansion = self._expansions.get(key)
+        if expansion is None:
+            return None
+        for name, value in expansion.environment.iteritems():
+            if environment.get(name) != value:
+                return None
+        return expansion
+
+    def put(self, key, expansion):
+        if not key is None:
+            self._expansions[key] = expansion
+
+
 class ConfigurationBuilder(LoggingObject):
     def __init__(self, name, environment, source_finder,
-                 nodes=None, hints=None):
+                 nodes=None, hints=None, launch_cache=None, includes=None):
         self.configuration = Configuration(name, env = environment)
         self.sources = source_finder
+        self.launch_cache = launch_cache
+        self.includes = includes if not includes is None else IncludeCache()
         self.errors = []
         self.node_specs = nodes if nodes is not None else {}
         self.hints = hints if not hints is None else {}
         self._future = []
+        self._recordings = []
         self._pkg_finder = PackageExtractor() # FIXME should this be given?
 
     def add_launch(self, launch_file):
@@ -824,13 +961,20 @@ class ConfigurationBuilder(LoggingObject):
     # ----- parameters can only be added in the end, because of rosparam
         for param in scope.parameters:
             self.configuration.parameters.add(param)
+
+    def link_parameters(self):
+        """Resolves, in a single pass, the parameter reads and writes of
+            all node instances, once every launch file has been added.
+        """
+        self.log.debug("Linking %d parameter accesses.", len(self._future))
         for link in self._future:
             link.make()
+        del self._future[:]
 
     def _analyse_tree(self, tree, scope, sub):
         for tag in tree.children:
             if tag.tag == "error":
-                self.errors.append(tag.text)
+                self._error(tag.text)
                 continue
             try:
                 condition = self._condition(tag.condition, sub)
@@ -839,7 +983,11 @@ class ConfigurationBuilder(LoggingObject):
                 handler = getattr(self, "_" + tag.tag + "_tag")
                 handler(tag, condition, scope, sub)
             except (ConfigurationError, SubstitutionError) as e:
-                self.errors.append(e.value)
+                # errors raised by _apply() are produced again on replay
+                if getattr(e, "applied", False):
+                    self.errors.append(e.value)
+                else:
+                    self._error(e.value)
 
     def _node_tag(self, tag, condition, scope, sub):
         pkg = sub.resolve(tag.package, strict = True)
@@ -847,20 +995,12 @@ class ConfigurationBuilder(LoggingObject):
         args = sub.resolve(tag.argv, strict = True)
         if not pkg or not exe:
             raise ConfigurationError("node tag is missing pkg or type")
-        node = self._get_node(pkg, exe, args)
         name = sub.resolve(tag.name, strict = True)
         ns = sub.resolve(tag.namespace, strict = True)
-        new_scope = scope.make_node(node, name, ns, args, condition)
+        new_scope = self._apply("node", scope, pkg, exe, args, name, ns,
+                                condition)
         self._analyse_tree(tag, new_scope, sub)
-        hints = self._merge_hints(node.node_name, new_scope.node.rosname.full)
-        config_hints = ConfigurationHints.make_hints(hints, new_scope)
-        new_scope.make_topics(advertise = config_hints.advertise,
-                              subscribe = config_hints.subscribe)
-        new_scope.make_services(service = config_hints.service,
-                                client = config_hints.client)
-        config_hints.make_missing_links(new_scope)
-        new_scope._make_param_links()
-        self._future.extend(new_scope._future)
+        self._apply("links", new_scope)
 
     def _include_tag(self, tag, condition, scope, sub):
         filepath = sub.resolve(tag.file, strict = True)
@@ -874,25 +1014,131 @@ class ConfigurationBuilder(LoggingObject):
             if not launch_file.tree:
                 raise ConfigurationError("cannot parse: " + launch_file.id)
         args = dict(scope.arguments) if pass_all_args else {}
-        new_scope = scope.child(ns, condition, launch = launch_file,
-                                args = args)
+        new_scope = self._apply("child", scope, ns, condition, launch_file,
+                                args)
         # define child args in the new scope
         self._analyse_tree(tag, new_scope, sub)
+        key = self.includes.key(launch_file, args, new_scope.conditions)
+        expansion = self.includes.get(key, sub.environment)
+        if expansion is None:
+            expansion = self._expand(launch_file, new_scope, sub, args)
+            if expansion.reusable:
+                self.includes.put(key, expansion)
+        else:
+            self._replay(expansion, new_scope)
+        sub.pkg_depends.update(expansion.pkg_depends)
+        sub.env_depends.update(expansion.env_depends)
+
+    def _expand(self, launch_file, scope, sub, args):
+        """Analyses an included launch file, recording what is done
+            with the resulting scopes so that it can be replayed.
+        """
+        expansion = IncludeExpansion(scope)
         new_sub = SubstitutionParser(args = args, env = sub.environment,
                                      pkgs = sub.packages,
-                                     dirname = launch_file.dir_path,
-                                     pkg_depends = sub.pkg_depends,
-                                     env_depends = sub.env_depends)
-        self._analyse_tree(launch_file.tree, new_scope, new_sub)
+                                     dirname = launch_file.dir_path)
+        self._recordings.append(expansion)
+        try:
+            self._analyse_tree(launch_file.tree, scope, new_sub)
+        finally:
+            self._recordings.pop()
+        expansion.freeze()
+        expansion.pkg_depends = set(new_sub.pkg_depends)
+        expansion.env_depends = set(new_sub.env_depends)
+        expansion.environment = {name: sub.environment.get(name)
+                                 for name in new_sub.env_depends}
+        if new_sub.anonymous:
+            # anonymous names must be different for every inclusion
+            expansion.reusable = False
+        if not expansion.reusable:
+            for recording in self._recordings:
+                recording.reusable = False
+        return expansion
+
+    def _replay(self, expansion, scope):
+        self.log.debug("Replaying include of %s.", scope.launch_file.id)
+        scopes = [scope]
+        for op, index, args, created in expansion.operations:
+            if op == "error":
+                self._error(args[0])
+                continue
+            if index < 0 or index >= len(scopes) or scopes[index] is None:
+                continue # the operation that created the scope failed
+            try:
+                result = self._apply(op, scopes[index],
+                                     *IncludeExpansion.snapshot(args))
+            except ConfigurationError as e:
+                self.errors.append(e.value)
+                result = None
+            if created:
+                scopes.append(result)
+
+    def _apply(self, op, scope, *args):
+        """Applies a resolved launch tag to a scope, recording it
+            in the include expansions under analysis.
+        """
+        operations = []
+        for recording in self._recordings:
+            operations.append(recording.record(op, scope, args))
+        try:
+            result = getattr(self, "_apply_" + op)(scope, *args)
+        except ConfigurationError as e:
+            e.applied = True
+            raise
+        for recording, operation in zip(self._recordings, operations):
+            recording.created(operation, result)
+        return result
+
+    def _apply_node(self, scope, pkg, exe, args, name, ns, condition):
+        node = self._get_node(pkg, exe, args)
+        return scope.make_node(node, name, ns, args,
+                               self._source_condition(condition))
+
+    def _apply_links(self, scope):
+        node = scope.node
+        hints = self._merge_hints(node.node.node_name, node.rosname.full)
+        config_hints = ConfigurationHints.make_hints(hints, scope)
+        scope.make_topics(advertise = config_hints.advertise,
+                          subscribe = config_hints.subscribe)
+        scope.make_services(service = config_hints.service,
+                            client = config_hints.client)
+        config_hints.make_missing_links(scope)
+        scope._make_param_links()
+        self._future.extend(scope._future)
+
+    def _apply_child(self, scope, ns, condition, launch_file, args):
+        return scope.child(ns, self._source_condition(condition),
+                           launch = launch_file, args = args)
+
+    def _apply_remap(self, scope, origin, target):
+        scope.remap(origin, target)
+
+    def _apply_params(self, scope, name, ptype, value, condition):
+        try:
+            scope.make_params(name, ptype, value,
+                              self._source_condition(condition))
+        except ValueError as e:
+            raise ConfigurationError(str(e))
+
+    def _apply_rosparam(self, scope, name, ns, value, condition):
+        scope.make_rosparam(name, ns, value, self._source_condition(condition))
+
+    def _apply_remove_param(self, scope, name, ns, condition):
+        scope.remove_param(name, ns, self._source_condition(condition))
+
+    def _error(self, msg):
+        self.errors.append(msg)
+        for recording in self._recordings:
+            recording.record("error", None, (msg,))
 
     def _remap_tag(self, tag, condition, scope, sub):
         assert not tag.children
         if not condition is True:
-            self.errors.append("cannot resolve conditional remap")
+            self._error("cannot resolve conditional remap")
         else:
             origin = sub.resolve(tag.origin, strict = True)
             target = sub.resolve(tag.target, strict = True)
-            scope.remap(origin, target)
+            self._apply("remap", scope, origin, target)
 
     def _param_tag(self, tag, condition, scope, sub):
         assert not tag.children
@@ -902,18 +1148,14 @@ class ConfigurationBuilder(LoggingObject):
             value = tag.value
         elif not tag.textfile is None:
             try:
-                with open(tag.textfile) as f:
-                    value = f.read()
-            except IOError as e:
+                value = yaml_documents.read(tag.textfile)
+            except (IOError, OSError) as e:
                 raise ConfigurationError("cannot read file: " + tag.textfile)
         elif not tag.binfile is None:
             value = None
         elif not tag.command is None:
             value = None
-        try:
-            scope.make_params(name, ptype, value, condition)
-        except ValueError as e:
-            raise ConfigurationError(str(e))
+        self._apply("params", scope, name, ptype, value, condition)
 
     def _rosparam_tag(self, tag, condition, scope, sub):
         assert not tag.children
@@ -924,21 +1166,20 @@ class ConfigurationBuilder(LoggingObject):
         if command == "load":
             if filepath:
                 try:
-                    with open(filepath) as f:
-                        value = f.read()
-                except IOError as e:
+                    value = yaml_documents.read(filepath)
+                except (IOError, OSError) as e:
                     raise ConfigurationError("cannot read file: " + filepath)
             else:
                 value = tag.text
                 if sub.resolve(tag.substitute, strict = True):
                     value = sub.resolve(value, strict = True)
-            scope.make_rosparam(name, ns, value, condition)
+            self._apply("rosparam", scope, name, ns, value, condition)
         elif command == "delete":
-            scope.remove_param(name, ns, condition)
+            self._apply("remove_param", scope, name, ns, condition)
 
     def _group_tag(self, tag, condition, scope, sub):
         ns = sub.resolve(tag.namespace, strict = True)
-        new_scope = scope.child(ns, condition)
+        new_scope = self._apply("child", scope, ns, condition, None, None)
         self._analyse_tree(tag, new_scope, sub)
 
     def _arg_tag(self, tag, condition, scope, sub):
@@ -966,15 +1207,21 @@ class ConfigurationBuilder(LoggingObject):
         assert isinstance(condition, tuple)
         value = sub.resolve(condition[1])
         if value is None:
-            # not sure if tag is part of the configuration
-            return SourceCondition(condition[1], # UnresolvedValue
-                location = self.configuration.roslaunch[-1].location)
+            # not sure if tag is part of the configuration;
+            # _source_condition() turns this into a SourceCondition
+            return condition[1] # UnresolvedValue
         if value is condition[0]:
             # tag is part of the configuration
             return True
         # tag is not part of the configuration
         return False
 
+    def _source_condition(self, condition):
+        if condition is True:
+            return True
+        return SourceCondition(condition, # UnresolvedValue
+            location = self.configuration.roslaunch[-1].location)
+
     def _get_node(self, pkg, exe, args):
         if exe == "nodelet":
             if not args:
@@ -1033,10 +1280,74 @@ class ConfigurationBuilder(LoggingObject):
     def _parse_launch_on_the_fly(self, launch_file):
         assert not launch_file.tree
         assert launch_file.language == "launch"
-        launch_parser = LaunchParser(pkgs = self.sources.packages)
+        launch_parser = LaunchParser(pkgs = self.sources.packages,
+                                     cache = self.launch_cache)
         self.log.debug("Parsing launch file: " + launch_file.path)
         try:
             launch_file.tree = launch_parser.parse(launch_file.path)
         except LaunchParserError as e:
             self.log.warning("Parsing error in %s:\n%s",
                              launch_file.path, str(e))
+
+
+###############################################################################
+# Parallel Building
+###############################################################################
+
+class ConfigurationTransfer(LoggingObject):
+    """Moves configurations built in worker processes to the parent process.
+        Workers are forked, so they already share the source model
+        (packages, files and nodes) and the environment. These objects
+        are pickled as references to the parent's objects, rather than
+        copied along with every configuration.
+    """
+    def __init__(self, database, environment):
+        self._keys = {}
+        self._objects = {}
+        self._register("environment", environment)
+        for collection in (database.packages, database.files, database.nodes):
+            for key, obj in collection.iteritems():
+                self._register(key, obj)
+
+    def dumps(self, configuration, errors):
+        # hard-coded nodes are loaded on demand, by any process
+        for key, node in HardcodedNodeParser._cache.iteritems():
+            self._register("hardcoded:" + key, node)
+        output = StringIO()
+        pickler = cPickle.Pickler(output, cPickle.HIGHEST_PROTOCOL)
+        pickler.persistent_id = self._persistent_id
+        pickler.dump((configuration, errors))
+        return output.getvalue()
+
+    def loads(self, data):
+        """Returns the (configuration, errors) pair built by a worker."""
+        shared = set()
+        def persistent_load(key):
+            obj = self._persistent_load(key)
+            shared.add(id(obj))
+            return obj
+        unpickler = cPickle.Unpickler(StringIO(data))
+        unpickler.persistent_load = persistent_load
+        configuration, errors = unpickler.load()
+        # instances were added to the worker's copy of the nodes
+        for instance in configuration.nodes:
+            if id(instance.node) in shared:
+                instance.node.instances.append(instance)
+        return configuration, errors
+
+    def _register(self, key, obj):
+        self._keys[id(obj)] = key
+        self._objects[key] = obj
+
+    def _persistent_id(self, obj):
+        return self._keys.get(id(obj))
+
+    def _persistent_load(self, key):
+        obj = self._objects.get(key)
+        if obj is None and key.startswith("hardcoded:node:"):
+            pkg, exe = key[15:].split("/", 1)
+            obj = HardcodedNodeParser.get(pkg, exe)
+            self._register(key, obj)
+        if obj is None:
+            raise cPickle.UnpicklingError("unknown shared object: " + key)
+        return obj
@@ -634,6 +634,7 @@ class HarosDatabase(LoggingObject):
         self.packages = {}
         self.files = {}
         self.nodes = {}
+        self.files_by_path = {}
     # ----- runtime
         self.configurations = []
     # ----- analysis
@@ -643,10 +644,7 @@ class HarosDatabase(LoggingObject):
         self.history = []
 
     def get_file(self, filepath):
-        for sf in self.files.itervalues():
-            if sf.path == filepath:
-                return sf
-        return None
+        return self.files_by_path.get(filepath)
 
     def register_project(self, project):
         self.project = project
@@ -656,6 +654,7 @@ class HarosDatabase(LoggingObject):
             self.packages[pkg.id] = pkg
             for sf in pkg.source_files:
                 self.files[sf.id] = sf
+                self.files_by_path.setdefault(sf.path, sf)
             for node in pkg.nodes:
                 self.nodes[node.id] = node
         self.configurations.extend(project.configurations)
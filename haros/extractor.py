@@ -23,9 +23,14 @@
 # Imports
 ###############################################################################
 
+from collections import Counter
+from copy import deepcopy
 from fnmatch import fnmatch
+import hashlib
 import itertools
+import json
 import logging
+from multiprocessing import Pool
 from operator import attrgetter
 import os
 import re
@@ -46,6 +51,7 @@ from bonsai.analysis import (
 )
 try:
     from bonsai.cpp.clang_parser import CppAstParser
+    import clang.cindex as clang
 except ImportError:
     CppAstParser = None
 from bonsai.py.py_parser import PyAstParser
@@ -53,6 +59,7 @@ from rospkg import RosPack, RosStack, ResourceNotFound
 from xml.etree.cElementTree import ElementTree
 from distutils.spawn import find_executable
 
+from .cache import FileStatsIndex
 from .cmake_parser import RosCMakeParser
 from .launch_parser import LaunchParser, LaunchParserError
 from .metamodel import (
@@ -129,7 +136,9 @@ def findRosPackages(paths = None, as_stack = False):
 class ProjectExtractor(LoggingObject):
     def __init__(self, index_file, env = None, pkg_cache = None,
                  repo_cache = None, repo_path = None, distro_url = None,
-                 require_repos = False, parse_nodes = False, node_cache = None):
+                 require_repos = False, parse_nodes = False, node_cache = None,
+                 jobs = 1, file_index = None, launch_cache = None,
+                 cmake_cache = None):
         self.log.debug("ProjectExtractor(%s, %s, %s)",
                        index_file, repo_path, distro_url)
         self.index_file = index_file
@@ -140,7 +149,15 @@ class ProjectExtractor(LoggingObject):
         self.environment = env if not env is None else {}
         self.package_cache = pkg_cache if not pkg_cache is None else {}
         self.repo_cache = repo_cache if not repo_cache is None else {}
-        self.node_cache = node_cache if not node_cache is None else {}
+        self.parse_cache = node_cache
+        self.node_cache = None
+        self.jobs = max(1, jobs or 1)
+        self.file_index = file_index
+        self.launch_cache = launch_cache
+        self.cmake_cache = cmake_cache
+        self.compile_flags = None
+        self.files_by_path = {}
+        self.files_by_name = {}
         self.project = None
         self.packages = None
         self.missing = None
@@ -161,7 +178,11 @@ class ProjectExtractor(LoggingObject):
         for name in self.missing:
             self.log.warning("Could not find package " + name)
         self._populate_packages_and_dependencies(settings=settings)
-        self._update_node_cache()
+        if self.parse_nodes:
+            self.compile_flags = self._load_compile_flags(settings)
+        self.node_cache = NodeCache(self.parse_cache, self.project.packages,
+                                    self.compile_flags,
+                                    files = self.files_by_name)
         self._find_nodes(settings)
 
     def _setup(self):
@@ -264,28 +285,57 @@ class ProjectExtractor(LoggingObject):
 
     def _populate_packages_and_dependencies(self, settings=None):
         found = set()
+        ignored_globs = None if settings is None else settings.ignored_globs
         extractor = PackageExtractor()
         extractor.packages = self.project.packages
-        for pkg in self.project.packages:
-            found.add(pkg.name)
-            analysis_ignore = extractor._populate_package(
-                pkg, ignored_globs=settings.ignored_globs)
-            if settings is not None:
-                settings.ignored_lines.update(analysis_ignore)
-        deps = extractor._extra
-        extractor._extra = []
-        while deps:
-            pkg = deps.pop()
-            assert pkg.name not in found
-            pkg._analyse = False
-            found.add(pkg.name)
-            self.project.packages.append(pkg)
-            analysis_ignore = extractor._populate_package(
-                pkg, ignored_globs=settings.ignored_globs)
-            if settings is not None:
-                settings.ignored_lines.update(analysis_ignore)
-            deps.extend(extractor._extra)
+        extractor.launch_cache = self.launch_cache
+        extractor.files_by_path = self.files_by_path
+        extractor.files_by_name = self.files_by_name
+        pool = None
+        file_index = None
+        if self.jobs > 1:
+            self.log.debug("Indexing packages with %d processes.", self.jobs)
+            pool = Pool(self.jobs)
+        if self.file_index:
+            file_index = FileStatsIndex(self.file_index)
+            if not file_index.open():
+                file_index = None
+        try:
+            for pkg in self.project.packages:
+                found.add(pkg.name)
+            ignores = extractor._populate_packages(
+                self.project.packages, ignored_globs=ignored_globs, pool=pool,
+                file_index=file_index)
+            self._update_ignored_lines(settings, ignores)
+            # extra packages are not analysed, hence they do not parse
+            # launch files and do not bring in more packages of their own;
+            # they are indexed in the same order as a LIFO traversal
+            deps = extractor._extra
             extractor._extra = []
+            while deps:
+                deps.reverse()
+                for pkg in deps:
+                    assert pkg.name not in found
+                    pkg._analyse = False
+                    found.add(pkg.name)
+                    self.project.packages.append(pkg)
+                ignores = extractor._populate_packages(
+                    deps, ignored_globs=ignored_globs, pool=pool,
+                    file_index=file_index)
+                self._update_ignored_lines(settings, ignores)
+                deps = extractor._extra
+                extractor._extra = []
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+            if file_index is not None:
+                file_index.close()
+
+    def _update_ignored_lines(self, settings, ignores):
+        if settings is not None:
+            for analysis_ignore in ignores:
+                settings.ignored_lines.update(analysis_ignore)
 
     def _find_nodes(self, settings):
         pkgs = {pkg.name: pkg for pkg in self.project.packages if pkg._analyse}
@@ -296,7 +346,10 @@ class ProjectExtractor(LoggingObject):
             self.log.warning("C++ AST parser not found.")
         extractor = NodeExtractor(pkgs, self.environment, ws = ws,
                                   node_cache = self.node_cache,
-                                  parse_nodes = self.parse_nodes)
+                                  parse_nodes = self.parse_nodes,
+                                  jobs = self.jobs,
+                                  files = self.files_by_path,
+                                  cmake_cache = self.cmake_cache)
         if self.parse_nodes and CppAstParser is not None:
             if settings is None:
                 CppAstParser.set_library_path()
@@ -318,58 +371,90 @@ class ProjectExtractor(LoggingObject):
         for pkg in self.project.packages:
             if pkg._analyse and pkg.name not in self.package_cache:
                 extractor.find_nodes(pkg)
+        extractor.extract_queued()
+        if self.compile_flags is not None:
+            for pkg in self.project.packages:
+                for node in pkg.nodes:
+                    node.compile_flags = self.compile_flags.digest(node)
+
+    def _load_compile_flags(self, settings):
+        if settings is None:
+            includes = CppAstParser.includes if CppAstParser else ""
+            return CompileFlags(None, includes)
+        return CompileFlags(settings.cpp_compile_db, settings.cpp_includes)
+
+
+class NodeCache(LoggingObject):
+    """Rebuilds Node objects from a ParseCache, only when requested.
+    Records are discarded if the node's source files, their contents
+    or the compile flags have changed since they were cached."""
+
+    def __init__(self, parse_cache, packages, compile_flags, files=None):
+        self.parse_cache = parse_cache
+        self.packages = {}
+        for pkg in packages:
+            self.packages.setdefault(pkg.name, pkg)
+        self.compile_flags = compile_flags
+        if files is None:
+            files = {(pkg.name, sf.full_name): sf
+                     for pkg in packages for sf in pkg.source_files}
+        self.files = files
+
+    def get(self, node_name, source_files):
+        if self.parse_cache is None or self.compile_flags is None:
+            return None # cached nodes are only valid when parsing nodes
+        datum = self.parse_cache.get(node_name)
+        if datum is None:
+            return None
+        if datum["files"] != [sf.full_name for sf in source_files]:
+            self.log.debug("Cached node %s: build files changed", node_name)
+            return None
+        if datum.get("digests") != [sf.digest for sf in source_files]:
+            # a file was modified, needs to be parsed again
+            self.log.debug("Cached node %s: files changed", node_name)
+            return None
+        try:
+            pkg = self._get_package(datum["package"])
+        except ValueError as e:
+            self.log.debug("Cached node %s: %s", node_name, e)
+            return None
+        node = Node(datum["name"], pkg, rosname = datum["rosname"],
+                    nodelet = datum["nodelet"])
+        node.source_files = list(source_files)
+        if datum.get("flags") != self.compile_flags.digest(node):
+            self.log.debug("Cached node %s: compile flags changed", node_name)
+            return None
+        self.load_primitives(node, datum)
+        self.parse_cache.reused.add(node_name)
+        return node
 
-    def _update_node_cache(self):
-        self.log.debug("Importing cached Nodes.")
-        data = [datum for datum in self.node_cache.itervalues()]
-        self.node_cache = {}
-        for datum in data:
-            try:
-                pkg = self._get_package(datum["package"])
-                source_files = self._get_files(pkg, datum["files"])
-            except ValueError as e:
-                # either a package or a file is no longer part of the analysis
-                self.log.debug("Cached node %s: %s", datum["name"], e)
-                continue
-            mtime = datum["timestamp"]
-            for sf in source_files:
-                if sf.timestamp > mtime:
-                    # a file was modified, needs to be parsed again
-                    continue
-            node = Node(datum["name"], pkg, rosname = datum["rosname"],
-                        nodelet = datum["nodelet"])
-            node.source_files = source_files
-            for p in datum["advertise"]:
-                node.advertise.append(self._pub_from_JSON(p))
-            for p in datum["subscribe"]:
-                node.subscribe.append(self._sub_from_JSON(p))
-            for p in datum["service"]:
-                node.service.append(self._srv_from_JSON(p))
-            for p in datum["client"]:
-                node.client.append(self._client_from_JSON(p))
-            for p in datum["readParam"]:
-                node.read_param.append(self._read_from_JSON(p))
-            for p in datum["writeParam"]:
-                node.write_param.append(self._write_from_JSON(p))
-            self.node_cache[node.node_name] = node
+    def load_primitives(self, node, datum):
+        for p in datum["advertise"]:
+            node.advertise.append(self._pub_from_JSON(p))
+        for p in datum["subscribe"]:
+            node.subscribe.append(self._sub_from_JSON(p))
+        for p in datum["service"]:
+            node.service.append(self._srv_from_JSON(p))
+        for p in datum["client"]:
+            node.client.append(self._client_from_JSON(p))
+        for p in datum["readParam"]:
+            node.read_param.append(self._read_from_JSON(p))
+        for p in datum["writeParam"]:
+            node.write_param.append(self._write_from_JSON(p))
 
     def _get_package(self, name):
-        for pkg in self.project.packages:
-            if pkg.name == name:
-                return pkg
-        raise ValueError("cannot find package: " + name)
+        pkg = self.packages.get(name)
+        if pkg is None:
+            raise ValueError("cannot find package: " + name)
+        return pkg
 
     def _get_files(self, pkg, filenames):
         files = []
         for filename in filenames:
-            found = False
-            for sf in pkg.source_files:
-                if sf.full_name == filename:
-                    found = True
-                    files.append(sf)
-                    break
-            if not found:
+            sf = self.files.get((pkg.name, filename))
+            if sf is None:
                 raise ValueError("cannot find file: " + filename)
+            files.append(sf)
         return files
 
     def _pub_from_JSON(self, datum):
@@ -431,6 +516,8 @@ class ProjectExtractor(LoggingObject):
                                   location = l(datum["location"]))
 
     def _location_from_JSON(self, datum):
+        if datum is None:
+            return None
         try:
             pkg = self._get_package(datum["package"])
             sf = None
@@ -443,6 +530,41 @@ class ProjectExtractor(LoggingObject):
                         fun = datum["function"], cls = datum["class"])
 
 
+class CompileFlags(LoggingObject):
+    """Digests of the compiler flags used to parse the files of a node,
+    based on the compilation database and the standard includes."""
+
+    def __init__(self, db_dir, includes):
+        self.includes = includes or ""
+        self.commands = {}
+        if db_dir:
+            self._load_database(os.path.join(db_dir, "compile_commands.json"))
+
+    def digest(self, node):
+        if node.language != "cpp":
+            return ""
+        sha = hashlib.sha1(self.includes)
+        for sf in node.source_files:
+            sha.update(sf.path)
+            for command in self.commands.get(os.path.abspath(sf.path), ()):
+                sha.update(command)
+        return sha.hexdigest()
+
+    def _load_database(self, path):
+        try:
+            with open(path, "r") as handle:
+                entries = json.load(handle)
+        except (IOError, ValueError) as e:
+            self.log.debug("No compilation database at %s: %s", path, e)
+            return
+        for entry in entries:
+            directory = entry.get("directory", "")
+            filepath = os.path.abspath(os.path.join(directory, entry["file"]))
+            command = entry.get("arguments") or entry.get("command")
+            self.commands.setdefault(filepath, []).append(
+                json.dumps([directory, command]))
+
+
 ###############################################################################
 # Repository Extractor
 ###############################################################################
@@ -599,6 +721,9 @@ class PackageExtractor(LoggingObject):
         self.altstack_pkgs = None
         self._pkg_cache = {}
         self._extra = []
+        self.launch_cache = None
+        self.files_by_path = {}
+        self.files_by_name = {}
 
     def refresh_package_cache(self):
         self.rospack_pkgs = None
@@ -666,15 +791,54 @@ class PackageExtractor(LoggingObject):
     EXCLUDED = (".git", "doc", "cmake", ".eggs", "__pycache__")
     _START_GLOB = (os.path.sep, '*', '?', '[')
 
-    def _populate_package(self, pkg, ignored_globs=None):
+    def _populate_packages(self, pkgs, ignored_globs=None, pool=None,
+                           file_index=None):
+        """Index and register the source files of a list of packages.
+        If a process pool is given, the file system walk and the file stats
+        are computed in parallel, but registration is still done in order.
+        Returns a list with the ignored lines of each package."""
+        if pool is None:
+            return [self._populate_package(pkg, ignored_globs=ignored_globs,
+                                           file_index=file_index)
+                    for pkg in pkgs]
+        index_path = None if file_index is None else file_index.path
+        tasks = [(pkg.name, pkg.path, ignored_globs, index_path)
+                 for pkg in pkgs if pkg.path]
+        results = iter(pool.map(_index_package_job, tasks, chunksize=1))
+        ignores = []
+        for pkg in pkgs:
+            if not pkg.path:
+                self.log.debug("Package %s has no path", pkg.name)
+                ignores.append({})
+                continue
+            self.log.info("Indexing source files for package %s", pkg.name)
+            files, analysis_ignore, records = next(results)
+            for source in files:
+                # files were built in a worker against a placeholder package
+                source.package = pkg
+            if file_index is not None:
+                file_index.merge(records)
+            self._register_files(pkg, files)
+            ignores.append(analysis_ignore)
+        return ignores
+
+    def _populate_package(self, pkg, ignored_globs=None, file_index=None):
         self.log.debug("PackageExtractor.populate(%s, %s)", pkg, ignored_globs)
         if not pkg.path:
             self.log.debug("Package %s has no path", pkg.name)
-            return
+            return {}
         self.log.info("Indexing source files for package %s", pkg.name)
+        files, analysis_ignore = self._index_files(pkg,
+            ignored_globs=ignored_globs, file_index=file_index)
+        self._register_files(pkg, files)
+        return analysis_ignore
+
+    @classmethod
+    def _index_files(cls, pkg, ignored_globs=None, file_index=None):
+        files = []
         analysis_ignore = {}
-        #pkgs = {pkg.id: pkg for pkg in self.packages}
-        launch_parser = LaunchParser(pkgs=self)
+        magic_calls = SourceFile.magic_calls
+        magic_avoided = SourceFile.magic_avoided
         prefix = len(pkg.path) + len(os.path.sep)
         if ignored_globs is None:
             ignored_globs = ()
@@ -682,38 +846,90 @@ class PackageExtractor(LoggingObject):
             ignored_globs = list(ignored_globs)
             for i in range(len(ignored_globs)):
                 c = ignored_globs[i][0]
-                if not c in self._START_GLOB:
+                if not c in cls._START_GLOB:
                     ignored_globs[i] = '*/' + ignored_globs[i]
-        for root, subdirs, files in os.walk(pkg.path, topdown=True):
-            if 'COLCON_IGNORE' in files or 'AMENT_IGNORE' in files or 'CATKIN_IGNORE' in files:
+        for root, subdirs, filenames in os.walk(pkg.path, topdown=True):
+            if 'COLCON_IGNORE' in filenames or 'AMENT_IGNORE' in filenames or 'CATKIN_IGNORE' in filenames:
                 del subdirs[:] # don't traverse into subdirectories
                 continue # skip
-            subdirs[:] = [d for d in subdirs if d not in self.EXCLUDED]
+            subdirs[:] = [d for d in subdirs if d not in cls.EXCLUDED]
             path = root[prefix:]
-            for filename in files:
-                self.log.debug("Found file %s at %s", filename, path)
-                source = SourceFile(filename, path, pkg)
-                sfn = os.path.join(pkg.name, source.full_name)
+            for filename in filenames:
+                cls.log.debug("Found file %s at %s", filename, path)
+                sfn = os.path.join(pkg.name, path, filename)
                 if any(fnmatch(sfn, pattern)
                        for pattern in ignored_globs):
-                    self.log.debug(
+                    cls.log.debug(
                         "File %s was ignored due to glob pattern", sfn)
                     continue # skip this file
-                ignore = source.set_file_stats()
+                source, ignore = cls._index_file(filename, path, pkg,
+                                                 file_index)
                 if any(v for v in ignore.itervalues()):
                     analysis_ignore[source.id] = ignore
-                if pkg._analyse and source.language == "launch":
-                    self.log.info("Parsing launch file: " + source.path)
-                    try:
-                        source.tree = launch_parser.parse(source.path)
-                    except LaunchParserError as e:
-                        self.log.warning("Parsing error in %s:\n%s",
-                                         source.path, str(e))
-                pkg.source_files.append(source)
-                pkg.size += source.size
-                pkg.lines += source.lines
-                pkg.sloc += source.sloc
-        return analysis_ignore
+                files.append(source)
+        cls.log.debug("Package %s: %d libmagic calls, %d avoided", pkg.name,
+                      SourceFile.magic_calls - magic_calls,
+                      SourceFile.magic_avoided - magic_avoided)
+        return files, analysis_ignore
+
+    @classmethod
+    def _index_file(cls, filename, path, pkg, file_index):
+        if file_index is None:
+            source = SourceFile(filename, path, pkg)
+            return source, source.set_file_stats()
+        filepath = os.path.abspath(os.path.join(pkg.path, path, filename))
+        stats = os.stat(filepath)
+        record = file_index.get(filepath, stats.st_mtime, stats.st_size)
+        if record is None:
+            source = SourceFile(filename, path, pkg)
+            ignore = source.set_file_stats()
+            file_index.put(filepath, source, ignore["*"])
+            return source, ignore
+        language, lines, sloc, digest, ignored_lines = record
+        source = SourceFile(filename, path, pkg, language=language)
+        source.size = stats.st_size
+        source.timestamp = stats.st_mtime
+        source.lines = lines
+        source.sloc = sloc
+        source.digest = digest
+        return source, {"*": ignored_lines}
+
+    def _register_files(self, pkg, files):
+        #pkgs = {pkg.id: pkg for pkg in self.packages}
+        launch_parser = LaunchParser(pkgs=self, cache=self.launch_cache)
+        for source in files:
+            if pkg._analyse and source.language == "launch":
+                self.log.info("Parsing launch file: " + source.path)
+                try:
+                    source.tree = launch_parser.parse(source.path)
+                except LaunchParserError as e:
+                    self.log.warning("Parsing error in %s:\n%s",
+                                     source.path, str(e))
+            pkg.source_files.append(source)
+            self.files_by_path.setdefault(source.path, source)
+            self.files_by_name.setdefault((pkg.name, source.full_name), source)
+            pkg.size += source.size
+            pkg.lines += source.lines
+            pkg.sloc += source.sloc
+
+
+def _index_package_job(task):
+    # Runs in a worker process; only picklable data crosses the boundary.
+    name, path, ignored_globs, index_path = task
+    pkg = Package(name)
+    pkg.path = path
+    if index_path is None:
+        files, ignore = PackageExtractor._index_files(pkg,
+            ignored_globs=ignored_globs)
+        return files, ignore, ()
+    file_index = FileStatsIndex(index_path, readonly=True)
+    file_index.open()
+    try:
+        files, ignore = PackageExtractor._index_files(pkg,
+            ignored_globs=ignored_globs, file_index=file_index)
+        return files, ignore, file_index.pending()
+    finally:
+        file_index.close()
 
 
 ###############################################################################
@@ -895,14 +1111,23 @@ class HardcodedNodeParser(LoggingObject):
 ###############################################################################
 
 class NodeExtractor(LoggingObject):
-    def __init__(self, pkgs, env, ws=None, node_cache=None, parse_nodes=False):
+    def __init__(self, pkgs, env, ws=None, node_cache=None, parse_nodes=False,
+                 jobs=1, files=None, cmake_cache=None):
         self.package = None
         self.packages = pkgs
+        if files is None:
+            files = {sf.path: sf for pkg in pkgs.itervalues()
+                     for sf in pkg.source_files}
+        self.files = files
         self.environment = env
         self.workspace = ws
         self.node_cache = node_cache
+        self.cmake_cache = cmake_cache
         self.parse_nodes = parse_nodes
+        self.jobs = jobs
         self.nodes = []
+        self._queued = []
+        self.py_modules = {}
         self.roscpp_extractor = None
         self.rospy_extractor = None
 
@@ -916,8 +1141,10 @@ class NodeExtractor(LoggingObject):
         if os.path.isfile(cmake_path):
             parser = RosCMakeParser(srcdir, bindir, pkgs = self.packages,
                                     env = self.environment,
-                                    vars = self._default_variables())
-            parser.parse(cmake_path)
+                                    vars = self._default_variables(),
+                                    cache = self.cmake_cache)
+            parser.parse(cmake_path,
+                         sources = [sf.path for sf in pkg.source_files])
             self._update_nodelets(parser.libraries)
             self._register_nodes(parser.executables)
         else:
@@ -957,9 +1184,9 @@ class NodeExtractor(LoggingObject):
         return v
 
     def _get_file(self, path):
-        for sf in self.package.source_files:
-            if sf.path == path:
-                return sf
+        sf = self.files.get(path)
+        if sf is not None and sf.package is self.package:
+            return sf
         return None
 
     def _update_nodelets(self, libraries):
@@ -999,20 +1226,23 @@ class NodeExtractor(LoggingObject):
 
     def _extract_primitives(self, force_when_cached=False):
         self.roscpp_extractor = RoscppExtractor(self.package, self.workspace)
-        self.rospy_extractor = RospyExtractor(self.package, self.workspace)
-
+        self.rospy_extractor = RospyExtractor(self.package, self.workspace,
+                                              modules = self.py_modules)
+        cpp_nodes = []
         for i in range(len(self.package.nodes)):
             node = self.package.nodes[i]
             self.log.debug("Extracting primitives for node %s", node.id)
             if node.source_tree is not None:
                 self.log.debug("Node already has a source tree. Skipped.")
                 continue
-            if (node.node_name in self.node_cache) and not force_when_cached:
-                self.log.debug("Using Node %s from cache.", node.node_name)
-                node = self.node_cache[node.node_name]
-                assert node.package is self.package
-                self.package.nodes[i] = node
-                continue
+            if self.node_cache is not None and not force_when_cached:
+                cached = self.node_cache.get(node.node_name,
+                                             node.source_files)
+                if cached is not None:
+                    self.log.debug("Using Node %s from cache.", node.node_name)
+                    assert cached.package is self.package
+                    self.package.nodes[i] = cached
+                    continue
             node.source_tree = CodeGlobalScope()
             node.advertise = []
             node.subscribe = []
@@ -1024,17 +1254,146 @@ class NodeExtractor(LoggingObject):
                 self.log.warning("no source files for node " + node.id)
 
             if node.language == "cpp" and CppAstParser is not None:
-                self.roscpp_extractor.extract(node)
-            elif node.language == 'py':
+                cpp_nodes.append(node)
+            elif node.language == 'python':
                 self.rospy_extractor.extract(node)
             else:
                 self.log.debug("Node written in %s.", node.language)
+        if self.jobs > 1:
+            self._queued.extend(cpp_nodes)
+        elif cpp_nodes:
+            tu_cache = TranslationUnitCache(cpp_nodes)
+            self.roscpp_extractor.tu_cache = tu_cache
+            for node in cpp_nodes:
+                self.roscpp_extractor.extract(node)
+            tu_cache.log_stats()
+
+    def extract_queued(self):
+        """Parses the queued C++ nodes in a pool of worker processes.
+        Workers send back only the extracted primitives; the nodes keep
+        an empty source tree."""
+        global _queued_cpp_nodes
+        if not self._queued:
+            return
+        self.log.debug("Parsing %d C++ nodes with %d processes.",
+                       len(self._queued), self.jobs)
+        # shared with the workers on fork, nodes are not pickled
+        _queued_cpp_nodes = (self._queued, self.workspace)
+        # translation units are only reused within a group, so files
+        # shared by nodes of different groups are parsed more than once
+        groups = _balanced_groups(self._queued, self.jobs)
+        pool = Pool(len(groups))
+        try:
+            results = pool.map(_extract_cpp_nodes_job, groups, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+            _queued_cpp_nodes = None
+        loader = self.node_cache
+        if loader is None:
+            loader = NodeCache(None, list(self.packages.itervalues()), None)
+        for group, data in zip(groups, results):
+            for i, datum in zip(group, data):
+                loader.load_primitives(self._queued[i], datum)
+        self._queued = []
+
+
+_queued_cpp_nodes = None
+
+def _extract_cpp_nodes_job(indices):
+    # Runs in a worker process forked by NodeExtractor.extract_queued.
+    nodes, workspace = _queued_cpp_nodes
+    nodes = [nodes[i] for i in indices]
+    tu_cache = TranslationUnitCache(nodes)
+    data = []
+    for node in nodes:
+        extractor = RoscppExtractor(node.package, workspace, tu_cache=tu_cache)
+        extractor.extract(node)
+        node.source_tree = None
+        data.append(node.to_JSON_object())
+    tu_cache.log_stats()
+    return data
+
+def _balanced_groups(nodes, n):
+    # node indices in at most n groups with similar numbers of source files,
+    # assigning the largest nodes first to the group with the fewest files
+    n = min(n, len(nodes))
+    groups = [[] for _ in xrange(n)]
+    sizes = [0] * n
+    order = sorted(xrange(len(nodes)),
+                   key = lambda i: (-len(nodes[i].source_files), i))
+    for i in order:
+        k = sizes.index(min(sizes))
+        groups[k].append(i)
+        sizes[k] += max(1, len(nodes[i].source_files))
+    for group in groups:
+        group.sort()
+    return groups
+
+
+class TranslationUnitCache(LoggingObject):
+    """Shares libclang translation units among the nodes of a run.
+    Units are keyed by file path, working directory and compiler
+    arguments, and are only kept while some other node still needs
+    the same file. Once no node needs a file, all of its units are
+    released, whatever their arguments."""
+
+    def __init__(self, nodes):
+        # path -> {(working directory, arguments): unit}
+        self.units = {}
+        self.uses = Counter(sf.path for node in nodes
+                            for sf in node.source_files)
+        self.hits = 0
+        self.misses = 0
+        self._index = None
+
+    def index_for(self, path):
+        """Returns an object to use as the clang.Index of a CppAstParser
+        while it parses the given file."""
+        self.uses[path] -= 1
+        return _CachedIndex(self, path, self.uses[path] > 0)
+
+    def parse(self, path, keep, args):
+        key = (os.getcwd(), tuple(args))
+        if keep:
+            unit = self.units.get(path, {}).get(key)
+        else:
+            unit = self.units.pop(path, {}).get(key)
+        if unit is not None:
+            self.hits += 1
+            return unit
+        self.misses += 1
+        if self._index is None:
+            self._index = clang.Index.create()
+        unit = self._index.parse(None, args)
+        if keep:
+            self.units.setdefault(path, {})[key] = unit
+        return unit
+
+    def log_stats(self):
+        self.log.debug("Translation units parsed: %d, reused: %d, held: %d",
+                       self.misses, self.hits,
+                       sum(len(units) for units in self.units.itervalues()))
+
+
+class _CachedIndex(object):
+    # Stands in for clang.Index inside CppAstParser (see _parse_from_db).
+    def __init__(self, cache, path, keep):
+        self.cache = cache
+        self.path = path
+        self.keep = keep
+
+    def parse(self, path, args = None, **kwargs):
+        assert path is None and not kwargs
+        return self.cache.parse(self.path, self.keep, args)
 
 
 class RoscppExtractor(LoggingObject):
-    def __init__(self, package, workspace):
+    def __init__(self, package, workspace, tu_cache=None):
         self.package = package
         self.workspace = workspace
+        self.tu_cache = tu_cache
+        self._files = None
 
     def extract(self, node):
         self.log.debug("Parsing C++ files for node %s", node.id)
@@ -1042,38 +1401,75 @@ class RoscppExtractor(LoggingObject):
 
         for sf in node.source_files:
             self.log.debug("Parsing C++ file %s", sf.path)
+            if self.tu_cache is not None:
+                # the parser only uses its index to parse translation units
+                parser._index = self.tu_cache.index_for(sf.path)
             if parser.parse(sf.path) is None:
                 self.log.warning("no compile commands for " + sf.path)
 
         node.source_tree = parser.global_scope
         # ----- queries after parsing, since global scope is reused -----------
-        self._query_comm_primitives(node, parser.global_scope)
-        self._query_nh_param_primitives(node, parser.global_scope)
-        self._query_param_primitives(node, parser.global_scope)
+        calls = self._collect_calls(parser.global_scope)
+        self._query_comm_primitives(node, calls)
+        self._query_nh_param_primitives(node, calls)
+        self._query_param_primitives(node, calls)
+
+    # Function names of interest, and the groups of calls they belong to.
+    CALL_GROUPS = {
+        "advertise": ("advertise",),
+        "subscribe": ("subscribe",),
+        "advertiseService": ("advertiseService",),
+        "serviceClient": ("serviceClient",),
+        "SubscriberFilter": ("SubscriberFilter",),
+        "Subscriber": ("Subscriber",),
+        "getParam": ("nh_read",),
+        "getParamCached": ("nh_read",),
+        "hasParam": ("nh_read",),
+        "searchParam": ("nh_read",),
+        "param": ("nh_read", "param_read"),
+        "setParam": ("nh_write",),
+        "deleteParam": ("nh_write",),
+        "get": ("param_read",),
+        "getCached": ("param_read",),
+        "has": ("param_read",),
+        "search": ("param_search",),
+        "set": ("param_write",),
+        "del": ("param_write",)
+    }
 
-    def _query_comm_primitives(self, node, gs):
-        for call in CodeQuery(gs).all_calls.where_name("advertise").get():
+    def _collect_calls(self, gs):
+        """Walks the global scope once, grouping function calls by name.
+        Within each group, calls keep their preorder traversal order."""
+        calls = {}
+        groups = self.CALL_GROUPS
+        for call in gs.filter(CodeFunctionCall, recursive=True):
+            for group in groups.get(call.name, ()):
+                calls.setdefault(group, []).append(call)
+        return calls
+
+    def _query_comm_primitives(self, node, calls):
+        for call in calls.get("advertise", ()):
             if call.canonical_type != "ros::Publisher":
                 continue
             self._on_publication(node,
                 self._resolve_node_handle(call.method_of), call)
-        for call in CodeQuery(gs).all_calls.where_name("subscribe").get():
+        for call in calls.get("subscribe", ()):
             if call.canonical_type != "ros::Subscriber":
                 continue
             self._on_subscription(node,
                 self._resolve_node_handle(call.method_of), call)
-        for call in CodeQuery(gs).all_calls.where_name("advertiseService").get():
+        for call in calls.get("advertiseService", ()):
             if call.canonical_type != "ros::ServiceServer":
                 continue
             self._on_service(node,
                 self._resolve_node_handle(call.method_of), call)
-        for call in CodeQuery(gs).all_calls.where_name("serviceClient").get():
+        for call in calls.get("serviceClient", ()):
             if call.canonical_type != "ros::ServiceClient":
                 continue
             self._on_client(node,
                 self._resolve_node_handle(call.method_of), call)
         self.log.debug("Looking for image_transport::SubscriberFilter calls.")
-        for call in CodeQuery(gs).all_calls.where_name("SubscriberFilter").get():
+        for call in calls.get("SubscriberFilter", ()):
             self.log.debug("Found: %s", call.pretty_str())
             self.log.debug("%s", type(call))
             self.log.debug("%s", call.__dict__)
@@ -1087,7 +1483,7 @@ class RoscppExtractor(LoggingObject):
                                   call, topic_pos = 1, queue_pos = 2,
                                   msg_type = "sensor_msgs/Image")
         self.log.debug("Looking for message_filters::Subscriber calls.")
-        for call in CodeQuery(gs).all_calls.where_name("Subscriber").get():
+        for call in calls.get("Subscriber", ()):
             self.log.debug("Found: %s", call.pretty_str())
             self.log.debug("%s", type(call))
             self.log.debug("%s", call.__dict__)
@@ -1100,7 +1496,7 @@ class RoscppExtractor(LoggingObject):
             self._on_subscription(node, self._resolve_node_handle(n),
                                   call, topic_pos = 1, queue_pos = 2)
         self.log.debug("Looking for image_transport::Subscriber calls.")
-        for call in CodeQuery(gs).all_calls.where_name("subscribe").get():
+        for call in calls.get("subscribe", ()):
             if call.canonical_type != "image_transport::Subscriber":
                 continue
             self.log.debug("Found: %s", call.pretty_str())
@@ -1110,7 +1506,7 @@ class RoscppExtractor(LoggingObject):
             self._on_subscription(node, self._resolve_it_node_handle(n),
                                   call, msg_type = "sensor_msgs/Image")
         self.log.debug("Looking for image_transport::Publisher.")
-        for call in CodeQuery(gs).all_calls.where_name("advertise").get():
+        for call in calls.get("advertise", ()):
             if call.canonical_type != "image_transport::Publisher":
                 continue
             self.log.debug("Found: %s", call.pretty_str())
@@ -1120,35 +1516,32 @@ class RoscppExtractor(LoggingObject):
             self._on_publication(node, self._resolve_it_node_handle(n),
                                  call, msg_type = "sensor_msgs/Image")
 
-    def _query_nh_param_primitives(self, node, gs):
+    def _query_nh_param_primitives(self, node, calls):
         nh_prefix = "c:@N@ros@S@NodeHandle@"
-        reads = ("getParam", "getParamCached", "param", "hasParam",
-                 "searchParam")
-        for call in CodeQuery(gs).all_calls.where_name(reads).get():
+        for call in calls.get("nh_read", ()):
             if (call.full_name.startswith("ros::NodeHandle")
                     or (isinstance(call.reference, str)
                         and call.reference.startswith(nh_prefix))):
                 self._on_read_param(node, self._resolve_node_handle(call),
                                     call)
 
-        writes = ("setParam", "deleteParam")
-        for call in CodeQuery(gs).all_calls.where_name(writes).get():
+        for call in calls.get("nh_write", ()):
             if (call.full_name.startswith("ros::NodeHandle")
                     or (isinstance(call.reference, str)
                         and call.reference.startswith(nh_prefix))):
                 self._on_write_param(node, self._resolve_node_handle(call),
                                      call)
 
-    def _query_param_primitives(self, node, gs):
+    def _query_param_primitives(self, node, calls):
         ros_prefix = "c:@N@ros@N@param@"
-        reads = ("get", "getCached", "param", "has")
-        for call in CodeQuery(gs).all_calls.where_name(reads).get():
+        for call in calls.get("param_read", ()):
             if (call.full_name.startswith("ros::param")
                     or (isinstance(call.reference, str)
                         and call.reference.startswith(ros_prefix))):
                 self._on_read_param(node, "", call)
-        for call in (CodeQuery(gs).all_calls.where_name("search")
-                     .where_result("bool").get()):
+        for call in calls.get("param_search", ()):
+            if call.result != "bool":
+                continue
             if (call.full_name.startswith("ros::param")
                     or (isinstance(call.reference, str)
                         and call.reference.startswith(ros_prefix))):
@@ -1159,8 +1552,7 @@ class RoscppExtractor(LoggingObject):
                 else:
                     ns = "~"
                 self._on_read_param(node, ns, call)
-        writes = ("set", "del")
-        for call in CodeQuery(gs).all_calls.where_name(writes).get():
+        for call in calls.get("param_write", ()):
             if (call.full_name.startswith("ros::param")
                     or (isinstance(call.reference, str)
                         and call.reference.startswith(ros_prefix))):
@@ -1259,13 +1651,11 @@ class RoscppExtractor(LoggingObject):
         self.log.debug("Found Write on %s/%s (%s)", ns, name, "string")
 
     def _call_location(self, call):
-        try:
-            source_file = next(
-                sf
-                for sf in self.package.source_files
-                if sf.path == call.file)
-        except StopIteration:
-            souce_file = None
+        if self._files is None:
+            self._files = {}
+            for sf in self.package.source_files:
+                self._files.setdefault(sf.path, sf)
+        source_file = self._files.get(call.file)
 
         function = call.function
         if function:
@@ -1460,13 +1850,11 @@ class RospyExtractor(LoggingObject):
         return ns, name
 
     def _call_location(self, call):
-        try:
-            source_file = next(
-                sf
-                for sf in self.package.source_files
-                if sf.path == call.file)
-        except StopIteration:
-            souce_file = None
+        if self._files is None:
+            self._files = {}
+            for sf in self.package.source_files:
+                self._files.setdefault(sf.path, sf)
+        source_file = self._files.get(call.file)
 
         function = call.function
         if function:
@@ -1572,37 +1960,38 @@ class RospyExtractor(LoggingObject):
         node.subscribe.append(sub)
         self.log.debug("Found Subscription on %s/%s (%s)", ns, name, msg_type)
 
-    def _query_comm_primitives(self, node, gs):
-        ##################################
-        # Topics
-        ##################################
-
-        publications = (CodeQuery(gs).all_calls
-                        .where_name(('Publisher', 'rospy.Publisher'))
-                        .get())
-        subscriptions = (CodeQuery(gs).all_calls
-                         .where_name(('Subscriber', 'rospy.Subscriber'))
-                         .get())
-        for call in publications:
-            self._on_publication(node, call)
-        for call in subscriptions:
-            self._on_subscription(node, call)
-
-        ##################################
-        # Services
-        ##################################
-
-        service_defs = (CodeQuery(gs).all_calls
-                        .where_name(self.all_rospy_names('service-def'))
-                        .get())
-        service_calls = (CodeQuery(gs).all_calls
-                         .where_name(self.all_rospy_names('service-call'))
-                         .get())
-        for call in service_defs:
-            self._on_service(node, call)
-        for call in service_calls:
-            self._on_client(node, call)
+    # primitive kinds, in the order their calls are processed
+    primitive_handlers = (
+        ('publication', '_on_publication'),
+        ('subscription', '_on_subscription'),
+        ('service-def', '_on_service'),
+        ('service-call', '_on_client'),
+    )
 
+    _dispatch_table = None
+
+    @classmethod
+    def dispatch_table(cls):
+        """Maps every name in all_rospy_names to its primitive kind."""
+        if cls._dispatch_table is None:
+            cls._dispatch_table = {
+                name: kind
+                for kind in cls.rospy_names
+                for name in cls.all_rospy_names(kind)
+            }
+        return cls._dispatch_table
+
+    def _query_comm_primitives(self, node, gs):
+        table = self.dispatch_table()
+        calls = {}
+        for call in gs.filter(CodeFunctionCall, recursive=True):
+            kind = table.get(call.name)
+            if kind is not None:
+                calls.setdefault(kind, []).append(call)
+        for kind, handler in self.primitive_handlers:
+            on_call = getattr(self, handler)
+            for call in calls.get(kind, ()):
+                on_call(node, call)
 
     def _setup_path(self):
         setup_file = os.path.join(self.package.path, 'setup.py')
@@ -1633,15 +2022,24 @@ class RospyExtractor(LoggingObject):
         root = package_dir.get('', '')
         return [os.path.join(self.package.path, root)]
 
-    def __init__(self, package, workspace):
+    def __init__(self, package, workspace, modules=None):
         self.package = package
         self.workspace = workspace
-        self.pythonpath = self._setup_path()
+        self.modules = modules if modules is not None else {}
+        self._pythonpath = None
+        self._files = None
+
+    @property
+    def pythonpath(self):
+        # setup.py is only parsed if the package has Python nodes
+        if self._pythonpath is None:
+            self._pythonpath = self._setup_path()
+        return self._pythonpath
 
     def extract(self, node):
         self.log.debug("Parsing Python files for node %s", node.id)
-        parser = PyAstParser(pythonpath=self.pythonpath,
-                             workspace=self.workspace)
+        parser = SharedPyAstParser(self.modules, pythonpath=self.pythonpath,
+                                   workspace=self.workspace)
         for sf in node.source_files:
             self.log.debug("Parsing Python file %s", sf.path)
             if parser.parse(sf.path) is None:
@@ -1657,3 +2055,30 @@ class RospyExtractor(LoggingObject):
         # ----- queries after parsing, since global scope is reused -----------
         self._query_comm_primitives(node, parser.global_scope)
         # self._query_param_primitives(node, parser.global_scope)
+
+
+class SharedPyAstParser(PyAstParser):
+    """A PyAstParser that reuses modules parsed by other parsers.
+    Each parser gets its own copy of a shared module, attached to its
+    global scope, so that the source trees of different nodes remain
+    separate; only the parsing of the file is saved."""
+
+    def __init__(self, modules, pythonpath=None, workspace=''):
+        PyAstParser.__init__(self, pythonpath=pythonpath, workspace=workspace)
+        self.modules = modules
+
+    def _parse_file(self, file_path):
+        if file_path in self.cache:
+            return self.cache[file_path]
+        entry = self.modules.get(file_path)
+        if entry is None:
+            entry = PyAstParser._parse_file(self, file_path)
+            self.modules[file_path] = entry
+            return entry
+        node, imported_names = entry
+        # references to the original global scope go to this parser's
+        node = deepcopy(node, {id(node.scope): self.global_scope})
+        entry = (node, list(imported_names))
+        self.cache[file_path] = entry
+        self.imported_names_list.extend(imported_names)
+        return entry
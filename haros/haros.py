@@ -25,7 +25,10 @@
 # + ~/.haros
 # |-- index.yaml
 # |-- configs.yaml
-# |-- parse_cache.json
+# |-- parse_cache.db
+# |-- file_index.db
+# |-- launch_cache.db
+# |-- cmake_cache.db
 # |-- log.txt
 # |-+ repositories
 #   |-+ ...
@@ -79,6 +82,8 @@
 #       -w  whitelist plugins
 #       -b  blacklist plugins
 #       -d  use given directory to load and export
+#       -j  number of processes used to index files, parse nodes
+#           and build configurations
 #   haros export [args]
 #       runs export only
 #       -v export viz files too
@@ -96,17 +101,20 @@
 ###############################################################################
 
 from argparse import ArgumentParser
-import json
 import logging
+from multiprocessing import Pool
 import os
 import tempfile
 
 from shutil import copyfile, rmtree
 from pkg_resources import Requirement, resource_filename
 
+from .cache import CMakeCache, LaunchTreeCache, ParseCache
 from .data import HarosDatabase, HarosSettings
 from .extractor import ProjectExtractor, HardcodedNodeParser
-from .config_builder import ConfigurationBuilder
+from .config_builder import (
+    ConfigurationBuilder, ConfigurationTransfer, IncludeCache
+)
 from .plugin_manager import Plugin
 from .analysis_manager import AnalysisManager
 from .export_manager import JsonExporter, JUnitExporter
@@ -146,7 +154,6 @@ class HarosLauncher(object):
             "#        rules: []\n"
             "#        metrics: []\n"
         ),
-        "parse_cache.json": "{}",
         "repositories": {},
         "export": {},
         "projects": {
@@ -215,7 +222,7 @@ class HarosLauncher(object):
             log=self.log, run_from_source=self.run_from_source,
             use_repos=args.use_repos, parse_nodes=args.parse_nodes,
             copy_env=args.env, use_cache=(not args.no_cache),
-            junit_xml_output=args.junit_xml_output,
+            jobs=args.jobs, junit_xml_output=args.junit_xml_output,
             minimal_output=args.minimal_output)
         return analyse.run()
 
@@ -257,7 +264,7 @@ class HarosLauncher(object):
             project_file, args.data_dir, log=self.log,
             run_from_source=self.run_from_source, use_repos=args.use_repos,
             ws=args.ws, copy_env=args.env, use_cache=(not args.no_cache),
-            junit_xml_output=args.junit_xml_output,
+            jobs=args.jobs, junit_xml_output=args.junit_xml_output,
             minimal_output=args.minimal_output)
         return parse.run()
 
@@ -305,6 +312,10 @@ class HarosLauncher(object):
                             help = "load/export using the given directory")
         parser.add_argument("--no-cache", action = "store_true",
                             help = "do not use available caches")
+        parser.add_argument("-j", "--jobs", type = int, default = 1,
+                            help = ("number of processes used to index "
+                                    "files, parse nodes and build "
+                                    "configurations (default: 1)"))
         parser.add_argument("--junit-xml-output", action='store_true',
                             help = "output JUnit XML report file(s)")
         parser.add_argument("--minimal-output", action='store_true',
@@ -332,6 +343,10 @@ class HarosLauncher(object):
                             help = "load/export using the given directory")
         parser.add_argument("--no-cache", action = "store_true",
                             help = "do not use available caches")
+        parser.add_argument("-j", "--jobs", type = int, default = 1,
+                            help = ("number of processes used to index "
+                                    "files, parse nodes and build "
+                                    "configurations (default: 1)"))
         parser.add_argument("--junit-xml-output", action='store_true',
                             help = "output JUnit XML report file(s)")
         parser.add_argument("--minimal-output", action='store_true',
@@ -381,6 +396,10 @@ class HarosLauncher(object):
         parser.add_argument("--ws", help = "set the catkin workspace directory")
         parser.add_argument("--no-cache", action = "store_true",
                             help = "do not use available caches")
+        parser.add_argument("-j", "--jobs", type = int, default = 1,
+                            help = ("number of processes used to index "
+                                    "files, parse nodes and build "
+                                    "configurations (default: 1)"))
         parser.add_argument("--junit-xml-output", action='store_true',
                             help = "output JUnit XML report file(s)")
         parser.add_argument("--minimal-output", action='store_true',
@@ -551,7 +570,7 @@ class HarosAnalyseRunner(HarosCommonExporter):
                  whitelist, blacklist, log = None, run_from_source = False,
                  use_repos = False, parse_nodes = False, copy_env = False,
                  use_cache = True, settings = None, junit_xml_output = False,
-                 minimal_output = False):
+                 minimal_output = False, jobs = 1):
         HarosRunner.__init__(self, haros_dir, config_path, log,
             run_from_source, junit_xml_output, minimal_output)
         self.project_file = project_file
@@ -559,6 +578,7 @@ class HarosAnalyseRunner(HarosCommonExporter):
         self.parse_nodes = parse_nodes
         self.copy_env = copy_env
         self.use_cache = use_cache
+        self.jobs = jobs
         self.whitelist = whitelist
         self.blacklist = blacklist
         self.settings = settings
@@ -589,34 +609,56 @@ class HarosAnalyseRunner(HarosCommonExporter):
         self.database = HarosDatabase()
         self._setup_lazy_node_parser()
         plugins, rules, metrics = self._load_definitions_and_plugins()
-        node_cache = {}
+        parse_cache = None
         if self.parse_nodes and self.use_cache:
-            parse_cache = os.path.join(self.root, "parse_cache.json")
-            try:
-                with open(parse_cache, "r") as f:
-                    node_cache = json.load(f)
-            except IOError as e:
-                self.log.warning("Could not read parsing cache: %s", e)
-        configs, nodes, env = self._extract_metamodel(node_cache, rules)
+            parse_cache = ParseCache(os.path.join(self.root, "parse_cache.db"))
+            if not parse_cache.open():
+                parse_cache = None
+        launch_cache = None
+        if self.use_cache:
+            launch_cache = LaunchTreeCache(
+                os.path.join(self.root, "launch_cache.db"))
+            if not launch_cache.open():
+                launch_cache = None
+        cmake_cache = None
+        if self.use_cache:
+            cmake_cache = CMakeCache(os.path.join(self.root, "cmake_cache.db"))
+            if not cmake_cache.open():
+                cmake_cache = None
+        configs, nodes, env = self._extract_metamodel(parse_cache, rules,
+            launch_cache=launch_cache, cmake_cache=cmake_cache)
+        if cmake_cache is not None:
+            cmake_cache.close()
         self.current_dir = os.path.join(self.io_projects_dir, self.project)
         self._load_history()
-        self._extract_configurations(self.database.project, configs, nodes, env)
+        self._extract_configurations(self.database.project, configs, nodes, env,
+                                     launch_cache)
+        if launch_cache is not None:
+            launch_cache.close()
         self._analyse(plugins, rules, metrics)
-        self._save_results(node_cache)
+        self._save_results(parse_cache)
         self.database = None
         return True
 
-    def _extract_metamodel(self, node_cache, rules):
+    def _extract_metamodel(self, parse_cache, rules, launch_cache=None,
+                           cmake_cache=None):
         print "[HAROS] Reading project and indexing source code..."
         self.log.debug("Project file %s", self.project_file)
         env = dict(os.environ) if self.copy_env else self.settings.environment
         distro = self.distro_url if self.use_repos else None
+        file_index = None
+        if self.use_cache:
+            file_index = os.path.join(self.root, "file_index.db")
         extractor = ProjectExtractor(self.project_file, env = env,
                                      repo_path = self.repo_dir,
                                      distro_url = distro,
                                      require_repos = True,
-                                     node_cache = node_cache,
-                                     parse_nodes = self.parse_nodes)
+                                     node_cache = parse_cache,
+                                     parse_nodes = self.parse_nodes,
+                                     jobs = self.jobs,
+                                     file_index = file_index,
+                                     launch_cache = launch_cache,
+                                     cmake_cache = cmake_cache)
         if self.parse_nodes:
             print "  > Parsing nodes might take some time."
         # NOTE: this updates settings with ignore-line comments
@@ -631,32 +673,81 @@ class HarosAnalyseRunner(HarosCommonExporter):
         rules.update(rs) # FIXME this is a hammer
         return extractor.configurations, extractor.node_specs, env
 
-    def _extract_configurations(self, project, configs, nodes, environment):
-        for name, data in configs.iteritems():
-            if isinstance(data, list):
-                builder = ConfigurationBuilder(name, environment, self.database)
-                launch_files = data if isinstance(data, list) else data["launch"]
-            else:
-                builder = ConfigurationBuilder(name, environment, self.database,
-                    nodes=nodes, hints=data.get("hints"))
-                launch_files = data["launch"]
-            for launch_file in launch_files:
-                parts = launch_file.split(os.sep, 1)
-                if not len(parts) == 2:
-                    raise ValueError("invalid launch file: " + launch_file)
-                pkg = self.database.packages.get("package:" + parts[0])
-                if not pkg:
-                    raise ValueError("unknown package: " + parts[0])
-                path = os.path.join(pkg.path, parts[1])
-                launch = self.database.get_file(path)
-                if not launch:
-                    raise ValueError("unknown launch file: " + launch_file)
-                builder.add_launch(launch)
-            for msg in builder.errors:
+    def _extract_configurations(self, project, configs, nodes, environment,
+                                launch_cache=None):
+        configs = list(configs.iteritems())
+        if self.jobs > 1 and len(configs) > 1:
+            results = self._build_configurations_in_parallel(configs, nodes,
+                environment, launch_cache)
+        else:
+            includes = IncludeCache()
+            results = (self._build_configuration(name, data, nodes,
+                           environment, launch_cache, includes)
+                       for name, data in configs)
+        for configuration, errors in results:
+            for msg in errors:
                 self.log.warning("Configuration %s: %s",
-                                 builder.configuration.name, msg)
-            project.configurations.append(builder.configuration)
-            self.database.configurations.append(builder.configuration)
+                                 configuration.name, msg)
+            project.configurations.append(configuration)
+            self.database.configurations.append(configuration)
+
+    def _build_configuration(self, name, data, nodes, environment,
+                             launch_cache, includes):
+        if isinstance(data, list):
+            builder = ConfigurationBuilder(name, environment, self.database,
+                launch_cache=launch_cache, includes=includes)
+            launch_files = data
+        else:
+            builder = ConfigurationBuilder(name, environment, self.database,
+                nodes=nodes, hints=data.get("hints"),
+                launch_cache=launch_cache, includes=includes)
+            launch_files = data["launch"]
+        for launch_file in launch_files:
+            parts = launch_file.split(os.sep, 1)
+            if not len(parts) == 2:
+                raise ValueError("invalid launch file: " + launch_file)
+            pkg = self.database.packages.get("package:" + parts[0])
+            if not pkg:
+                raise ValueError("unknown package: " + parts[0])
+            path = os.path.join(pkg.path, parts[1])
+            launch = self.database.get_file(path)
+            if not launch:
+                raise ValueError("unknown launch file: " + launch_file)
+            builder.add_launch(launch)
+        builder.link_parameters()
+        return builder.configuration, builder.errors
+
+    def _build_configurations_in_parallel(self, configs, nodes, environment,
+                                          launch_cache):
+        """Builds configurations in a pool of worker processes.
+        Workers are forked, so the database is shared rather than pickled;
+        results are returned in the same order as the given configurations.
+        """
+        global _configuration_builds
+        self.log.debug("Building %d configurations with %d processes.",
+                       len(configs), self.jobs)
+        cache_path = None
+        if launch_cache is not None:
+            # let the workers see the launch files parsed so far
+            launch_cache.commit()
+            cache_path = launch_cache.path
+        transfer = ConfigurationTransfer(self.database, environment)
+        _configuration_builds = (self, configs, nodes, environment,
+                                 cache_path, transfer)
+        pool = Pool(min(self.jobs, len(configs)))
+        try:
+            results = pool.map(_build_configuration_job,
+                               xrange(len(configs)), chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+            _configuration_builds = None
+        configurations = []
+        for data, records in results:
+            if launch_cache is not None:
+                launch_cache.merge(records)
+            configurations.append(transfer.loads(data))
+        return configurations
 
     def _load_history(self):
         """
@@ -723,7 +814,7 @@ class HarosAnalyseRunner(HarosCommonExporter):
         finally:
             rmtree(temp_path)
 
-    def _save_results(self, node_cache):
+    def _save_results(self, parse_cache):
         print "[HAROS] Saving analysis results..."
         if self.export_viz:
             viz.install(self.viz_dir, self.run_from_source, minimal_output=self.minimal_output)
@@ -746,15 +837,34 @@ class HarosAnalyseRunner(HarosCommonExporter):
         if self.junit_xml_output:
             junit_exporter = JUnitExporter()
             junit_exporter.export_report(self.data_dir, self.database)
-        if self.parse_nodes and self.use_cache:
+        if parse_cache is not None:
+            # only nodes that were parsed in this run need to be stored
             for node in self.database.nodes.itervalues():
-                node_cache[node.node_name] = node.to_JSON_object()
-            parse_cache = os.path.join(self.root, "parse_cache.json")
-            try:
-                with open(parse_cache, "w") as f:
-                    json.dump(node_cache, f, indent=2, separators=(",", ":"))
-            except IOError as e:
-                self.log.warning("Could not save parsing cache: %s", e)
+                if node.node_name not in parse_cache.reused:
+                    parse_cache.put(node.node_name, node.to_JSON_object())
+            parse_cache.close()
+
+
+_configuration_builds = None
+
+def _build_configuration_job(index):
+    # Runs in a worker process forked by _build_configurations_in_parallel.
+    runner, configs, nodes, environment, cache_path, transfer = \
+        _configuration_builds
+    name, data = configs[index]
+    launch_cache = None
+    if cache_path is not None:
+        launch_cache = LaunchTreeCache(cache_path, readonly=True)
+        if not launch_cache.open():
+            launch_cache = None
+    try:
+        configuration, errors = runner._build_configuration(name, data,
+            nodes, environment, launch_cache, IncludeCache())
+        records = () if launch_cache is None else launch_cache.pending()
+        return transfer.dumps(configuration, errors), records
+    finally:
+        if launch_cache is not None:
+            launch_cache.close()
 
 
 ###############################################################################
@@ -766,14 +876,14 @@ class HarosParseRunner(HarosAnalyseRunner):
                  log=None, run_from_source=False, use_repos=False, ws=None,
                  copy_env=False, use_cache=True, settings=None,
                  junit_xml_output = False,
-                 minimal_output = False):
+                 minimal_output = False, jobs=1):
         HarosAnalyseRunner.__init__(
             self, haros_dir, config_path, project_file, data_dir,
             [], [], log=log, run_from_source=run_from_source,
             use_repos=use_repos, parse_nodes=True, copy_env=copy_env,
             use_cache=use_cache, settings=settings,
             junit_xml_output=junit_xml_output,
-            minimal_output=minimal_output
+            minimal_output=minimal_output, jobs=jobs
         )
         self.workspace = ws
 
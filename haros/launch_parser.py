@@ -128,25 +128,18 @@ class SubstitutionParser(object):
             result = UnresolvedValue()
             result.append(("eval", value[7:-1]))
             return result
-        if self.ERROR_PATTERN.search(value):
-            raise SubstitutionError("'$' cannot appear within expression")
-        match = self.PATTERN.search(value)
-        if not match:
+        if not "$" in value:
+            return self.convert_str(value, conversion)
+        program = self._programs.get(value)
+        if program is None:
+            program = self._compile(value)
+        if not program:
             return self.convert_str(value, conversion)
         result = UnresolvedValue()
-        rest = value
-        while match:
-            parts = [part for part in match.group(1).split() if part]
-            if not parts[0] in self.COMMANDS:
-                raise SubstitutionError("invalid command: " + parts[0])
-            prefix = rest[:match.start()]
-            if prefix:
-                result.append(prefix)
-            result.append(getattr(self, "_" + parts[0])(parts))
-            rest = rest[match.end():]
-            match = self.PATTERN.search(rest)
-        if rest:
-            result.append(rest)
+        for op in program:
+            if isinstance(op, tuple):
+                op = self._HANDLERS[op[0]](self, op)
+            result.append(op)
         return self.convert_unresolved(result, conversion)
 
     def resolve(self, value, conversion = str, strict = False):
@@ -158,16 +151,39 @@ class SubstitutionParser(object):
                 parts.append(part)
             else:
                 assert isinstance(part, tuple)
-                value = getattr(self, "_" + part[0])(part)
+                value = self._HANDLERS[part[0]](self, part)
                 if isinstance(value, tuple):
                     # a SubstitutionError here cannot be distinguished
-                    # from one coming from getattr above
+                    # from one coming from the command above
                     if not strict:
                         return None
                     raise SubstitutionError("cannot resolve: " + str(value))
                 parts.append(value)
         return self.convert_str("".join(parts), conversion)
 
+    # compiled strings, shared by all parsers; a program is a tuple of
+    # literal strings and command tuples, and it is empty for literals
+    _programs = {}
+
+    @classmethod
+    def _compile(cls, value):
+        if cls.ERROR_PATTERN.search(value):
+            raise SubstitutionError("'$' cannot appear within expression")
+        program = []
+        start = 0
+        for match in cls.PATTERN.finditer(value):
+            parts = tuple(part for part in match.group(1).split() if part)
+            if not parts[0] in cls.COMMANDS:
+                raise SubstitutionError("invalid command: " + parts[0])
+            if match.start() > start:
+                program.append(value[start:match.start()])
+            program.append(parts)
+            start = match.end()
+        if program and start < len(value):
+            program.append(value[start:])
+        program = cls._programs[value] = tuple(program)
+        return program
+
     def to_bool(self, value):
         if value is True or value == "1" or str(value).lower() == "true":
             return True
@@ -277,6 +293,16 @@ class SubstitutionParser(object):
                 os.getpid(), random.randint(0, sys.maxsize))
             return name.replace('.', '_').replace('-', '_').replace(':', '_')
 
+    _HANDLERS = {
+        "find": _find,
+        "env": _env,
+        "optenv": _optenv,
+        "dirname": _dirname,
+        "anon": _anon,
+        "arg": _arg,
+        "eval": _eval
+    }
+
 
 ###############################################################################
 # Launch XML Parser
@@ -649,13 +675,43 @@ class LaunchParser(object):
         "test": TestTag
     }
 
-    def __init__(self, pkgs = None):
+    def __init__(self, pkgs = None, cache = None):
         self.sub_parser = None
         self.packages = pkgs if not pkgs is None else {}
+        self.cache = cache
 
     def parse(self, filepath):
         if not filepath or not os.path.isfile(filepath):
             raise LaunchParserError("not a file: " + str(filepath))
+        if self.cache is None:
+            return self._parse(filepath)
+        stats = os.stat(filepath)
+        record = self.cache.get(filepath, stats.st_mtime, stats.st_size)
+        if record is not None:
+            tree, error, packages = record
+            if all(self._package_path(name) == path
+                   for name, path in packages):
+                if error is not None:
+                    raise LaunchParserError(error)
+                return tree
+        try:
+            tree = self._parse(filepath)
+            error = None
+        except LaunchParserError as e:
+            tree = None
+            error = e.value
+        packages = ()
+        if self.sub_parser is not None:
+            packages = [(name, self._package_path(name))
+                        for name in sorted(self.sub_parser.pkg_depends)]
+        self.cache.put(filepath, stats.st_mtime, stats.st_size,
+                       tree, error, packages)
+        if error is not None:
+            raise LaunchParserError(error)
+        return tree
+
+    def _parse(self, filepath):
+        self.sub_parser = None
         try:
             self.sub_parser = SubstitutionParser(pkgs = self.packages)
             xml_root = ET.parse(filepath).getroot()
@@ -665,6 +721,17 @@ class LaunchParser(object):
         except ET.ParseError as e:
             raise LaunchParserError(str(e))
 
+    def _package_path(self, name):
+        # looking packages up again also replays their discovery;
+        # None for unknown packages, "" for packages without a path
+        try:
+            package = self.packages.get("package:" + name)
+        except KeyError:
+            package = None
+        if not package:
+            return None
+        return package.path or ""
+
     def _parse_tag(self, tag):
         if not tag.tag in self.TAGS:
             return ErrorTag("unknown tag: " + tag.tag)
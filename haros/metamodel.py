@@ -24,7 +24,9 @@
 ###############################################################################
 
 from collections import Counter
+import hashlib
 import os
+import re
 
 import magic as file_cmd
 
@@ -308,8 +310,23 @@ class SourceFile(SourceObject):
     ACTION = '.action'
     YAML = ('.yaml', '.yml')
     CMAKELISTS = 'CMakeLists.txt'
-
-    def __init__(self, name, directory, pkg):
+    CPP_EXT = ('.c', '.cc', '.cpp', '.cxx', '.c++', '.h', '.hh', '.hpp',
+               '.hxx', '.h++', '.ipp', '.tpp', '.inl')
+    # extensions known not to hold C++ or Python source code
+    OTHER_EXT = frozenset((
+        '.txt', '.md', '.rst', '.xml', '.xacro', '.urdf', '.sdf', '.srdf',
+        '.world', '.rviz', '.json', '.ini', '.csv', '.html', '.css', '.js',
+        '.dox', '.pyc', '.pyo', '.so', '.a', '.o', '.png', '.jpg', '.jpeg',
+        '.gif', '.bmp', '.pgm', '.ppm', '.svg', '.pdf', '.dae', '.stl',
+        '.obj', '.mtl', '.bag', '.zip', '.gz', '.tar', '.pcd', '.cmake',
+        '.in', '.rules', '.sh', '.bash', '.perspective', '.ui', '.qrc'
+    ))
+
+    # number of libmagic calls performed and avoided by _get_language
+    magic_calls = 0
+    magic_avoided = 0
+
+    def __init__(self, name, directory, pkg, language = None):
         id = ("file:" + pkg.name + "/" + directory.replace(os.path.sep, "/")
               + "/" + name)
         SourceObject.__init__(self, id, name)
@@ -318,12 +335,13 @@ class SourceFile(SourceObject):
         self.dir_path = os.path.join(pkg.path, directory)
         self.path = os.path.join(pkg.path, directory, name)
         self.package = pkg
-        self.language = self._get_language()
+        self.language = language or self._get_language()
         self.tree = None
         self.size = 0
         self.lines = 0
         self.sloc = 0
         self.timestamp = 0
+        self.digest = None
 
     @property
     def scope(self):
@@ -353,8 +371,10 @@ class SourceFile(SourceObject):
         ignore_all = []
         to_ignore = {"*": ignore_all}
         ilp, inlp = self._ignore_parsers()
+        sha = hashlib.sha1()
         with open(self.path, "r") as handle:
             for line in handle:
+                sha.update(line)
                 self.lines += 1
                 sline = line.strip()
                 if sline:
@@ -363,6 +383,7 @@ class SourceFile(SourceObject):
                         ignore_all.append(self.lines)
                     elif inlp(sline):
                         ignore_all.append(self.lines + 1)
+        self.digest = sha.hexdigest()
         return to_ignore
 
     def to_JSON_object(self):
@@ -378,11 +399,21 @@ class SourceFile(SourceObject):
         }
 
     def _get_language(self):
+        language = self._classify()
+        if language is not None:
+            SourceFile.magic_avoided += 1
+            return language
+        SourceFile.magic_calls += 1
         file_type = file_cmd.from_file(self.path).lower()
         if file_type.startswith(self.CPP):
             return 'cpp'
         if self.PYTHON in file_type:
             return 'python'
+        return 'unknown'
+
+    def _classify(self):
+        """Classifies the file from its name, extension or shebang line.
+        Returns None if libmagic has to be used."""
         if self.name.endswith(self.LAUNCH):
             return 'launch'
         if self.name == self.PKG_XML:
@@ -397,7 +428,21 @@ class SourceFile(SourceObject):
             return 'yaml'
         if self.name == self.CMAKELISTS:
             return 'cmake'
-        return 'unknown'
+        ext = os.path.splitext(self.name)[1].lower()
+        if ext in self.CPP_EXT:
+            return 'cpp'
+        if ext in self.OTHER_EXT:
+            return 'unknown'
+        # Python files are recognised by their shebang line; as before,
+        # libmagic decides for those without one (e.g., empty modules)
+        try:
+            with open(self.path, "rb") as handle:
+                line = handle.readline(128)
+        except IOError:
+            return 'unknown'
+        if line.startswith("#!"):
+            return 'python' if "python" in line else 'unknown'
+        return None
 
     def __str__(self):
         return self.__repr__()
@@ -589,6 +634,7 @@ class Node(SourceObject):
         self.client = []
         self.read_param = []
         self.write_param = []
+        self.compile_flags = ""
 
     @property
     def scope(self):
@@ -624,6 +670,8 @@ class Node(SourceObject):
             "rosname": self.rosname,
             "nodelet": self.nodelet_class,
             "files": [f.full_name for f in self.source_files],
+            "digests": [f.digest for f in self.source_files],
+            "flags": self.compile_flags,
             "advertise": [p.to_JSON_object() for p in self.advertise],
             "subscribe": [p.to_JSON_object() for p in self.subscribe],
             "service": [p.to_JSON_object() for p in self.service],
@@ -657,6 +705,9 @@ class Node(SourceObject):
 ###############################################################################
 
 class RosName(object):
+    # (pattern, compiled pattern) pairs, by full name
+    _patterns = {}
+
     def __init__(self, name, ns = "/", private_ns = "", remaps = None):
         self._given = name
         self._name = RosName.transform(name, ns = ns, private_ns = private_ns,
@@ -695,6 +746,34 @@ class RosName(object):
 
     @property
     def pattern(self):
+        return self._compiled()[0]
+
+    @property
+    def regex(self):
+        return self._compiled()[1]
+
+    @property
+    def prefix(self):
+        # any name matched by the pattern starts with this prefix;
+        # "/a/?/b" also matches "/a/b", so the slash before "/?/" is dropped
+        name = self._name
+        i = name.find("?")
+        if i < 0:
+            return name
+        if i > 0 and name[i-1] == "/" and name[i+1:i+2] == "/":
+            return name[:i-1]
+        return name[:i]
+
+    def _compiled(self):
+        # kept out of the instance, so that pickled names stay small
+        compiled = RosName._patterns.get(self._name)
+        if compiled is None:
+            pattern = self._make_pattern()
+            compiled = (pattern, re.compile(pattern))
+            RosName._patterns[self._name] = compiled
+        return compiled
+
+    def _make_pattern(self):
         parts = []
         prev = ""
         n = len(self._name)
@@ -1112,6 +1191,102 @@ class Parameter(Resource):
         }
 
 
+class _TrieNode(object):
+    # module level, so that collections can be pickled
+    def __init__(self):
+        self.children = {}
+        self.items = None
+
+
+class NamespaceTrie(object):
+    """Index of items by ROS name, following the namespace hierarchy.
+        Each component of a name is a level of the trie, so namespaces
+        can be listed or removed without visiting unrelated names.
+    """
+
+    def __init__(self):
+        self.root = _TrieNode()
+
+    def get(self, name):
+        node = self._find(name)
+        if node is None:
+            return None
+        return node.items
+
+    def add(self, name, item):
+        node = self.root
+        for part in self._split(name):
+            child = node.children.get(part)
+            if child is None:
+                child = node.children[part] = _TrieNode()
+            node = child
+        if node.items is None:
+            node.items = []
+        node.items.append(item)
+        return node.items
+
+    def namespace(self, ns):
+        """Yields (name, items) for the name ns and all names under it."""
+        ns = ns.rstrip("/")
+        node = self._find(ns)
+        if node is not None:
+            for entry in self._walk(ns, node):
+                yield entry
+
+    def with_prefix(self, prefix):
+        """Yields (name, items) for all names that start with prefix."""
+        parts = prefix.split("/")
+        node = self.root
+        for part in parts[:-1]:
+            node = node.children.get(part)
+            if node is None:
+                return
+        base = "/".join(parts[:-1])
+        last = parts[-1]
+        for part, child in node.children.iteritems():
+            if part.startswith(last):
+                name = part if not parts[:-1] else base + "/" + part
+                for entry in self._walk(name, child):
+                    yield entry
+
+    def remove(self, ns):
+        """Removes the name ns and all names under it.
+            Returns the removed (name, items) pairs.
+        """
+        ns = ns.rstrip("/")
+        parts = self._split(ns)
+        parent = self.root
+        for part in parts[:-1]:
+            parent = parent.children.get(part)
+            if parent is None:
+                return []
+        node = parent.children.pop(parts[-1], None)
+        if node is None:
+            return []
+        return list(self._walk(ns, node))
+
+    def _find(self, name):
+        node = self.root
+        for part in self._split(name):
+            node = node.children.get(part)
+            if node is None:
+                return None
+        return node
+
+    def _walk(self, name, node):
+        stack = [(name, node)]
+        while stack:
+            name, node = stack.pop()
+            if node.items:
+                yield name, node.items
+            for part, child in node.children.iteritems():
+                stack.append((name + "/" + part, child))
+
+    def _split(self, name):
+        # "/a/b" -> ["", "a", "b"]; the empty part holds global names
+        return name.split("/")
+
+
 class ResourceCollection(object):
     def __init__(self, iterable):
         self.all = []
@@ -1119,6 +1294,11 @@ class ResourceCollection(object):
         self.unresolved = []
         self.conditional = []
         self.counter = Counter()
+        # (insertion number, resource) pairs, by id and by namespace;
+        # both indexes share the same lists
+        self._by_name = {}
+        self._trie = NamespaceTrie()
+        self._added = 0
         if not iterable is None:
             for resource in iterable:
                 self.add(resource)
@@ -1136,24 +1316,68 @@ class ResourceCollection(object):
         return self.all.__iter__()
 
     def get(self, name, conditional = True):
-        for resource in reversed(self.all):
-            if resource.id == name:
-                if conditional or not resource.conditions:
-                    return resource
+        for i, resource in reversed(self._by_name.get(name, ())):
+            if conditional or not resource.conditions:
+                return resource
         return None
 
     def get_all(self, name, conditional = True):
         resources = []
-        for resource in self.all:
-            if resource.id == name:
-                if conditional or not resource.conditions:
-                    resources.append(resource)
+        for i, resource in self._by_name.get(name, ()):
+            if conditional or not resource.conditions:
+                resources.append(resource)
         return resources
 
+    def match(self, rosname, conditional = True):
+        """Returns, in insertion order, the resources whose name matches
+            the pattern of the given (unresolved) RosName.
+            Only names that share the literal prefix of the pattern
+            are tested against it.
+        """
+        pattern = rosname.regex
+        entries = []
+        for name, items in self._trie.with_prefix(rosname.prefix):
+            if pattern.match(name):
+                entries.extend(items)
+        return self._select(entries, conditional)
+
+    def in_namespace(self, ns, conditional = True):
+        """Returns, in insertion order, the resources named ns
+            or within the namespace ns.
+        """
+        entries = []
+        for name, items in self._trie.namespace(ns):
+            entries.extend(items)
+        return self._select(entries, conditional)
+
+    def remove_namespace(self, ns):
+        """Removes the resources named ns or within the namespace ns.
+            Returns the removed resources, in insertion order.
+        """
+        entries = []
+        for name, items in self._trie.remove(ns):
+            del self._by_name[name]
+            del self.counter[name]
+            entries.extend(items)
+        removed = self._select(entries, True)
+        if removed:
+            ids = set(id(resource) for resource in removed)
+            for resources in (self.all, self.enabled, self.unresolved,
+                              self.conditional):
+                resources[:] = [r for r in resources if not id(r) in ids]
+        return removed
+
     def get_collisions(self):
         return len(self.all) - len(self.counter)
 
     def add(self, resource):
+        entries = self._by_name.get(resource.id)
+        if entries is None:
+            entries = self._trie.add(resource.id, (self._added, resource))
+            self._by_name[resource.id] = entries
+        else:
+            entries.append((self._added, resource))
+        self._added += 1
         self.all.append(resource)
         if resource.conditions:
             self.conditional.append(resource)
@@ -1165,6 +1389,11 @@ class ResourceCollection(object):
         self.counter[resource.id] += 1
         return previous
 
+    def _select(self, entries, conditional):
+        entries.sort(key = lambda entry: entry[0])
+        return [resource for i, resource in entries
+                if conditional or not resource.conditions]
+
 
 class Configuration(MetamodelObject):
     """A configuration is more or less equivalent to an application.
@@ -27,6 +27,8 @@
 from __future__ import unicode_literals
 from builtins import str, bytes
 
+import hashlib
+import os
 import sys
 
 from pyflwor.parser import Parser
@@ -47,12 +49,13 @@ class MonkeyPatchLexer(Lexer):
 
 
 class MonkeyPatchParser(Parser):
-    def __new__(cls, pyflwor_dir, **kwargs):
+    def __new__(cls, pyflwor_dir, picklefile=None, **kwargs):
         self = super(Parser, cls).__new__(cls, **kwargs)
         self.names = dict()
         self.yacc = yacc.yacc(module=self, debug=False,
                               optimize=True, write_tables=False,
-                              outputdir=pyflwor_dir, **kwargs)
+                              outputdir=pyflwor_dir, picklefile=picklefile,
+                              **kwargs)
         return self.yacc
 
 
@@ -61,12 +64,33 @@ class MonkeyPatchParser(Parser):
 ###############################################################################
 
 def make_parser(pyflwor_dir):
+    """Returns a function that compiles a query into a function of a
+    namespace. Compiled queries are memoized by query text, and the parser
+    tables are kept in 'pyflwor_dir', so that they are generated once."""
     if pyflwor_dir not in sys.path:
         sys.path.insert(0, pyflwor_dir)
-    def execute(query, namespace):
-        lexer = MonkeyPatchLexer(pyflwor_dir)
-        parser = MonkeyPatchParser(pyflwor_dir)
-        qbytes = bytes(query, "utf-8").decode("unicode_escape")
-        qfunction = parser.parse(qbytes, lexer=lexer)
-        return qfunction(namespace)
-    return execute
+    picklefile = None
+    if pyflwor_dir:
+        picklefile = os.path.join(pyflwor_dir,
+                                  "parsetab_" + _grammar_digest() + ".pickle")
+    queries = {}
+    def compile_query(query):
+        qfunction = queries.get(query)
+        if qfunction is None:
+            lexer = MonkeyPatchLexer(pyflwor_dir)
+            parser = MonkeyPatchParser(pyflwor_dir, picklefile=picklefile)
+            qbytes = bytes(query, "utf-8").decode("unicode_escape")
+            qfunction = parser.parse(qbytes, lexer=lexer)
+            queries[query] = qfunction
+        return qfunction
+    return compile_query
+
+
+def _grammar_digest():
+    # optimized parsers do not check whether their tables are up to date,
+    # so tables are named after the grammar of the installed pyflwor
+    rules = sorted((name, getattr(Parser, name).__doc__)
+                   for name in dir(Parser) if name.startswith("p_"))
+    grammar = repr((getattr(Parser, "precedence", None),
+                    getattr(Parser, "tokens", None), rules))
+    return hashlib.sha1(grammar.encode("utf-8")).hexdigest()[:16]